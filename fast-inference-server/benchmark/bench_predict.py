@@ -0,0 +1,389 @@
+"""Load test and latency benchmark for the /predict endpoint.
+
+Drives the Starlette app either in-process through its ASGI interface, or over HTTP against a server started on
+localhost or already running at --url, and reports throughput and latency percentiles.
+
+    python bench_predict.py --concurrency 32 --rows 1 --payload raw
+    python bench_predict.py --target localhost --concurrency 64
+    python bench_predict.py --compare --output results.json
+    python bench_predict.py --compare --baseline last_release.json
+"""
+import argparse
+import asyncio
+import http.client
+import io
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+import ujson
+
+
+SERVER_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'fast_inference_server'))
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'raw': 'application/octet-stream',
+    'npy': 'application/x-npy',
+}
+# the serving modes --compare runs through, every combination of these
+COMPARE_MATRIX = {
+    'model_mode': ['eager', 'script'],
+    'payload': ['json', 'raw'],
+    'batching': [False, True],
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed, rows):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'rows_per_second': len(latencies) * rows / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies) * 1000 if latencies else None,
+            **{f'p{p}': percentile(latencies, p) * 1000 if latencies else None for p in (50, 95, 99, 99.9)},
+            'max': latencies[-1] * 1000 if latencies else None,
+        },
+    }
+
+
+def make_payload(kind, rows, features, seed=0):
+    array = np.random.default_rng(seed).standard_normal((rows, features), dtype=np.float32)
+    if kind == 'json':
+        return ujson.dumps(array.tolist()).encode()
+    if kind == 'raw':
+        return array.astype('<f4').tobytes()
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def write_model(model_dir, features, outputs):
+    sys.path.insert(0, SERVER_DIR)
+    import torch
+    from models import LinearRegression
+    torch.save(LinearRegression(features, outputs).state_dict(), os.path.join(model_dir, 'model.torch'))
+
+
+def server_env(args, model_dir):
+    env = dict(os.environ,
+               MODEL_DIR=model_dir,
+               MODEL_MODE=args.model_mode,
+               BATCHING_ENABLED='1' if args.batching else '0',
+               BATCH_MAX_SIZE=str(args.batch_max_size),
+               BATCH_MAX_WAIT_US=str(args.batch_max_wait_us),
+               INFERENCE_WORKERS=str(args.inference_workers),
+               INFERENCE_MAX_PENDING=str(max(64, args.concurrency * 2)))
+    return env
+
+
+class AsgiClient:
+    """Calls an ASGI app directly, without a socket in between."""
+
+    def __init__(self, app):
+        self.app = app
+        self._lifespan = None
+        self._lifespan_events = None
+
+    async def start(self):
+        self._lifespan_events = asyncio.Queue()
+        started = asyncio.get_event_loop().create_future()
+
+        async def receive():
+            return await self._lifespan_events.get()
+
+        async def send(message):
+            if message['type'] == 'lifespan.startup.complete':
+                started.set_result(None)
+            elif message['type'] == 'lifespan.startup.failed':
+                started.set_exception(RuntimeError(message.get('message')))
+
+        self._lifespan = asyncio.ensure_future(self.app({'type': 'lifespan'}, receive, send))
+        await self._lifespan_events.put({'type': 'lifespan.startup'})
+        await started
+
+    async def stop(self):
+        await self._lifespan_events.put({'type': 'lifespan.shutdown'})
+        await self._lifespan
+
+    async def post(self, path, body, headers):
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'POST',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+            'client': ('127.0.0.1', 0),
+            'server': ('127.0.0.1', 80),
+        }
+        request_sent = False
+        response = {'status': None, 'body': []}
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            # the client never disconnects, the app stops listening once the response is sent
+            await asyncio.get_event_loop().create_future()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['body'].append(message.get('body', b''))
+
+        await self.app(scope, receive, send)
+        return response['status'], b''.join(response['body'])
+
+
+async def drive_asgi(client, path, body, headers, requests, concurrency):
+    latencies, errors = [], 0
+    counter = itertools.count()
+
+    async def worker():
+        nonlocal errors
+        while next(counter) < requests:
+            start = time.perf_counter()
+            status, _ = await client.post(path, body, headers)
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+
+def drive_http(url, body, headers, requests, concurrency):
+    parts = urlsplit(url)
+    latencies, errors = [], 0
+    counter = itertools.count()
+
+    def worker():
+        nonlocal errors
+        # one keep-alive connection per worker thread
+        connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        try:
+            while next(counter) < requests:
+                start = time.perf_counter()
+                connection.request('POST', parts.path or '/predict', body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return latencies, errors, time.perf_counter() - start
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(url, timeout=60):
+    parts = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=1)
+            connection.request('GET', '/')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'server at {url} did not come up within {timeout}s')
+
+
+def run(args):
+    body = make_payload(args.payload, args.rows, args.features)
+    # answer in the same format the request came in, so json runs measure json both ways
+    headers = {'content-type': CONTENT_TYPES[args.payload], 'accept': CONTENT_TYPES[args.payload]}
+    with tempfile.TemporaryDirectory() as model_dir:
+        if args.target == 'url':
+            drive_http(args.url, body, headers, args.warmup, args.concurrency)
+            latencies, errors, elapsed = drive_http(args.url, body, headers, args.requests, args.concurrency)
+        elif args.target == 'localhost':
+            write_model(model_dir, args.features, args.outputs)
+            port = free_port()
+            url = f'http://127.0.0.1:{port}/predict'
+            server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port),
+                                       '--log-level', 'warning'],
+                                      cwd=SERVER_DIR, env=server_env(args, model_dir))
+            try:
+                wait_for_server(url)
+                drive_http(url, body, headers, args.warmup, args.concurrency)
+                latencies, errors, elapsed = drive_http(url, body, headers, args.requests, args.concurrency)
+            finally:
+                server.terminate()
+                server.wait()
+        else:
+            write_model(model_dir, args.features, args.outputs)
+            os.environ.update(server_env(args, model_dir))
+            sys.path.insert(0, SERVER_DIR)
+            import main
+
+            async def drive():
+                client = AsgiClient(main.app)
+                await client.start()
+                try:
+                    await drive_asgi(client, '/predict', body, headers, args.warmup, args.concurrency)
+                    return await drive_asgi(client, '/predict', body, headers, args.requests, args.concurrency)
+                finally:
+                    await client.stop()
+
+            latencies, errors, elapsed = asyncio.run(drive())
+
+    return {
+        'config': {k: getattr(args, k) for k in ('target', 'model_mode', 'payload', 'batching', 'rows', 'features',
+                                                 'outputs', 'concurrency', 'requests')},
+        'results': summarize(latencies, errors, elapsed, args.rows),
+    }
+
+
+def compare(args):
+    """Runs every serving mode in COMPARE_MATRIX in its own process, since the server reads its config on import."""
+    results = []
+    keys = list(COMPARE_MATRIX)
+    for values in itertools.product(*COMPARE_MATRIX.values()):
+        config = dict(zip(keys, values))
+        command = [sys.executable, os.path.abspath(__file__), '--json',
+                   '--target', args.target,
+                   '--model-mode', config['model_mode'],
+                   '--payload', config['payload'],
+                   '--rows', str(args.rows),
+                   '--features', str(args.features),
+                   '--outputs', str(args.outputs),
+                   '--concurrency', str(args.concurrency),
+                   '--requests', str(args.requests),
+                   '--warmup', str(args.warmup),
+                   '--batch-max-size', str(args.batch_max_size),
+                   '--batch-max-wait-us', str(args.batch_max_wait_us),
+                   '--inference-workers', str(args.inference_workers)]
+        if config['batching']:
+            command.append('--batching')
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        print_result(result)
+        results.append(result)
+    return results
+
+
+def print_result(result):
+    config, results = result['config'], result['results']
+    latency = results['latency_ms']
+    print(f"{config['model_mode']:>6} {config['payload']:>4} batching={str(config['batching']):5} "
+          f"rows={config['rows']:<4} c={config['concurrency']:<4} "
+          f"{results['requests_per_second']:9.1f} req/s {results['rows_per_second']:10.1f} rows/s  "
+          f"p50={_ms(latency['p50'])} p95={_ms(latency['p95'])} p99={_ms(latency['p99'])} "
+          f"p99.9={_ms(latency['p99.9'])} errors={results['errors']}", flush=True)
+
+
+def _ms(latency):
+    # summarize has no latencies to report when every request failed
+    return 'n/a' if latency is None else f'{latency:.2f}ms'
+
+
+def check_baseline(results, baseline_file, tolerance):
+    """Returns the results whose p99 latency regressed by more than `tolerance` against a saved run."""
+    with open(baseline_file) as f:
+        baseline = {json.dumps(r['config'], sort_keys=True): r['results'] for r in json.load(f)['runs']}
+    regressions = []
+    for result in results:
+        previous = baseline.get(json.dumps(result['config'], sort_keys=True))
+        if previous is None:
+            continue
+        before, after = previous['latency_ms']['p99'], result['results']['latency_ms']['p99']
+        if not before:
+            continue
+        if after is None:
+            regressions.append((result['config'], before, after))
+            print(f"p99 regressed from {before:.2f}ms to no successful requests for {result['config']}")
+        elif after > before * (1 + tolerance):
+            regressions.append((result['config'], before, after))
+            print(f"p99 regressed from {before:.2f}ms to {after:.2f}ms for {result['config']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the /predict endpoint')
+    parser.add_argument('--target', choices=['inprocess', 'localhost', 'url'], default='inprocess',
+                        help='drive the app through ASGI in this process, over HTTP against a uvicorn server started '
+                             'on localhost, or against an already running server at --url')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8080/predict')
+    parser.add_argument('--model-mode', choices=['eager', 'script', 'freeze'], default='eager')
+    parser.add_argument('--payload', choices=list(CONTENT_TYPES), default='json')
+    parser.add_argument('--batching', action='store_true')
+    parser.add_argument('--batch-max-size', type=int, default=64)
+    parser.add_argument('--batch-max-wait-us', type=int, default=500)
+    parser.add_argument('--inference-workers', type=int, default=1)
+    parser.add_argument('--rows', type=int, default=1, help='rows per request')
+    parser.add_argument('--features', type=int, default=1)
+    parser.add_argument('--outputs', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=500)
+    parser.add_argument('--compare', action='store_true', help='run every serving mode and compare them')
+    parser.add_argument('--output', type=str, help='save the results to this json file')
+    parser.add_argument('--baseline', type=str, help='compare p99 latency against results saved with --output')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative p99 regression')
+    parser.add_argument('--json', action='store_true', help='print the result as a single json line')
+    args = parser.parse_args()
+    if args.target == 'url' and args.compare:
+        parser.error('--compare starts its own servers and can not be combined with --target url')
+
+    if args.compare:
+        results = compare(args)
+    else:
+        results = [run(args)]
+        if args.json:
+            print(json.dumps(results[0]))
+            return
+        print_result(results[0])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'cpus': os.cpu_count(),
+                       'runs': results}, f, indent=2)
+    if args.baseline and check_baseline(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
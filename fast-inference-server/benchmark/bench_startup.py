@@ -0,0 +1,122 @@
+"""Startup time benchmark for the inference server.
+
+Starts a uvicorn server on localhost over and over and measures the time from launching the process until it answers
+the health check, until /ready reports the models are warm and until the first prediction comes back.
+
+    python bench_startup.py --runs 5
+    python bench_startup.py --compare --output startup.json
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_predict import SERVER_DIR, free_port, make_payload, write_model
+
+
+# (model file, model mode) pairs --compare runs, each with models loaded before and after the server starts listening
+COMPARE_MODELS = [('torch', 'eager'), ('torch', 'freeze'), ('ts', 'freeze')]
+
+
+def prepare_model_dir(model_dir, model_format, model_mode, features, outputs):
+    write_model(model_dir, features, outputs)
+    if model_format == 'ts':
+        from models import export_model, load_model, prepare_model
+        state_dict_file = os.path.join(model_dir, 'model.torch')
+        export_model(prepare_model(load_model(state_dict_file), mode=model_mode), os.path.join(model_dir, 'model.ts'))
+        os.remove(state_dict_file)
+
+
+def poll(port, method, path, body=None, headers=None, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                return time.perf_counter()
+        except OSError:
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f'{method} {path} did not succeed within {timeout}s')
+
+
+def measure(model_dir, model_mode, background, features):
+    port = free_port()
+    env = dict(os.environ,
+               MODEL_DIR=model_dir,
+               MODEL_MODE=model_mode,
+               PRELOAD_IN_BACKGROUND='1' if background else '0')
+    body = make_payload('raw', 1, features)
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port),
+                               '--log-level', 'warning'],
+                              cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL)
+    try:
+        live = poll(port, 'GET', '/')
+        ready = poll(port, 'GET', '/ready')
+        predicted = poll(port, 'POST', '/predict', body=body, headers={'content-type': 'application/octet-stream'})
+    finally:
+        server.terminate()
+        server.wait()
+    return {'live': live - start, 'ready': ready - start, 'first_prediction': predicted - start}
+
+
+def run(model_format, model_mode, background, runs, features, outputs):
+    with tempfile.TemporaryDirectory() as model_dir:
+        prepare_model_dir(model_dir, model_format, model_mode, features, outputs)
+        timings = [measure(model_dir, model_mode, background, features) for _ in range(runs)]
+    result = {
+        'config': {'model_format': model_format, 'model_mode': model_mode, 'background': background,
+                   'features': features, 'outputs': outputs, 'runs': runs},
+        'seconds': {stage: {'min': min(t[stage] for t in timings),
+                            'median': statistics.median(t[stage] for t in timings),
+                            'max': max(t[stage] for t in timings)}
+                    for stage in ('live', 'ready', 'first_prediction')},
+    }
+    seconds = result['seconds']
+    print(f"{model_format:>5} {model_mode:>6} background={str(background):5} "
+          f"live={seconds['live']['median']:.2f}s ready={seconds['ready']['median']:.2f}s "
+          f"first prediction={seconds['first_prediction']['median']:.2f}s (median of {runs})", flush=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark time to first prediction of the inference server')
+    parser.add_argument('--model-format', choices=['torch', 'ts'], default='torch',
+                        help='serve a state dict, or a TorchScript archive written by export_model.py')
+    parser.add_argument('--model-mode', choices=['eager', 'script', 'freeze'], default='eager')
+    parser.add_argument('--background', action='store_true', help='load models after the server starts listening')
+    parser.add_argument('--features', type=int, default=1)
+    parser.add_argument('--outputs', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--compare', action='store_true', help='run every combination in COMPARE_MODELS')
+    parser.add_argument('--output', type=str, help='save the results to this json file')
+    args = parser.parse_args()
+
+    if args.compare:
+        results = [run(model_format, model_mode, background, args.runs, args.features, args.outputs)
+                   for (model_format, model_mode), background in itertools.product(COMPARE_MODELS, [False, True])]
+    else:
+        results = [run(args.model_format, args.model_mode, args.background, args.runs, args.features, args.outputs)]
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'cpus': os.cpu_count(),
+                       'runs': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import asyncio
+
+import torch
+
+
+class MicroBatcher:
+    """Gathers concurrent prediction requests into a single forward pass.
+
+    Requests are queued until either `max_batch_size` rows have been collected or `max_wait_us` microseconds have
+    passed since the first request of the batch arrived. The rows are concatenated, run through `run_batch` once and
+    each caller gets back its own slice of the output. At most `max_concurrent_batches` batches run at once and at
+    most `max_queue` requests may wait for a batch, past that `predict` raises `asyncio.QueueFull`. When a batch fails
+    its requests are run again one by one, so an error only reaches the caller whose rows caused it.
+    """
+
+    def __init__(self, run_batch, max_batch_size=64, max_wait_us=500, max_concurrent_batches=1, max_queue=1024):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_us / 1_000_000
+        self.max_concurrent_batches = max_concurrent_batches
+        self.max_queue = max_queue
+        self._queue = None
+        self._slots = None
+        self._worker = None
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._worker = asyncio.ensure_future(self._collect())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    @property
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def predict(self, tensor):
+        if tensor.dim() not in (1, 2):
+            raise ValueError(f'expected a row or a 2-d batch of rows, got shape {tuple(tensor.shape)}')
+        # a 1-d tensor is a single row, keep the caller's shape on the way back out
+        single_row = tensor.dim() == 1
+        rows = tensor.unsqueeze(0) if single_row else tensor
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((rows, future))
+        out = await future
+        return out.squeeze(0) if single_row else out
+
+    async def _collect(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                size = batch[0][0].shape[0]
+                deadline = loop.time() + self.max_wait
+                while size < self.max_batch_size:
+                    if self._queue.empty():
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        try:
+                            item = await asyncio.wait_for(self._queue.get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                    else:
+                        item = self._queue.get_nowait()
+                    batch.append(item)
+                    size += item[0].shape[0]
+                # while every slot is busy the queue keeps filling, so the next batch comes out larger
+                await self._slots.acquire()
+            except asyncio.CancelledError:
+                _fail(batch, asyncio.CancelledError())
+                raise
+            except Exception as e:
+                # fail the requests at hand, the collector has to keep running for everyone else
+                _fail(batch, e)
+                continue
+            asyncio.ensure_future(self._execute(batch))
+
+    async def _execute(self, batch):
+        try:
+            # rows of different widths can't share a forward pass, give each width its own
+            groups = {}
+            for item in batch:
+                groups.setdefault(tuple(item[0].shape[1:]), []).append(item)
+            for group in groups.values():
+                await self._run(group)
+        finally:
+            self._slots.release()
+
+    async def _run(self, batch):
+        try:
+            sizes = [rows.shape[0] for rows, _ in batch]
+            out = await self.run_batch(torch.cat([rows for rows, _ in batch]))
+            parts = torch.split(out, sizes)
+        except Exception as e:
+            if len(batch) == 1:
+                _fail(batch, e)
+                return
+            # run the requests one at a time, so only the one that caused the error fails with it
+            for item in batch:
+                await self._run([item])
+            return
+        for (_, future), part in zip(batch, parts):
+            if not future.done():
+                future.set_result(part)
+
+
+def _fail(batch, error):
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(error)
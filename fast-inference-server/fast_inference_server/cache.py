@@ -0,0 +1,64 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """Caches encoded prediction responses for repeated request bodies.
+
+    Entries are keyed on a hash of the raw body together with the model, its version and the request and response
+    formats. At most `max_entries` entries and `max_bytes` bytes of response bodies are kept, the least recently used
+    are evicted past that and entries older than `ttl` seconds are never served.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(served, body, content_type, accept):
+        return served.name, served.version, content_type, accept, hashlib.blake2b(body, digest_size=16).digest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, response):
+        size = len(response.body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (response, time.monotonic(), size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, model_name):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == model_name]:
+                self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class ExecutorSaturated(Exception):
+    pass
+
+
+class InferenceExecutor:
+    """Runs forward passes on a dedicated thread pool so they never block the event loop.
+
+    At most `max_pending` calls may be running or waiting at once, anything beyond that is rejected with
+    `ExecutorSaturated` instead of queueing without bound. Without `intra_op_threads` the pool threads use the torch
+    thread count of the thread that started the executor.
+    """
+
+    def __init__(self, workers=1, intra_op_threads=None, max_pending=64):
+        self.workers = workers
+        self.intra_op_threads = intra_op_threads
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def start(self):
+        if self.intra_op_threads is None:
+            self.intra_op_threads = torch.get_num_threads()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                        thread_name_prefix='inference',
+                                        initializer=self._init_thread)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def _init_thread(self):
+        torch.set_num_threads(self.intra_op_threads)
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise ExecutorSaturated(f'{self.pending} inference calls pending')
+            self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
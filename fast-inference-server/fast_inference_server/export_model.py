@@ -0,0 +1,19 @@
+import argparse
+
+from models import export_model, load_model, prepare_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pre-compile a model state dict into a TorchScript archive the server "
+                                                 "loads without rebuilding or scripting the model")
+    parser.add_argument("model_file", type=str, help="LinearRegression state dict, e.g. models/model.torch")
+    parser.add_argument("artifact_file", type=str, help="archive to write, e.g. models/model.ts")
+    parser.add_argument("--mode", type=str, choices=['script', 'freeze'], default='freeze')
+    args = parser.parse_args()
+
+    export_model(prepare_model(load_model(args.model_file), mode=args.mode), args.artifact_file)
+    print(f'wrote {args.mode} model to: {args.artifact_file}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import os
+
+# gunicorn picks this file up from the working directory, every setting can be overridden from the environment
+bind = os.environ.get('BIND', '0.0.0.0:8080')
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+worker_class = 'uvicorn.workers.UvicornWorker'
+# import the app, and with it the PRELOAD_MODELS, once in the master so the forked workers share the weights
+preload_app = os.environ.get('PRELOAD_APP', '1') == '1'
+pin_workers = os.environ.get('PIN_WORKERS', '1') == '1'
+
+
+def post_fork(server, worker):
+    if not pin_workers or not hasattr(os, 'sched_setaffinity'):
+        return
+    # split the cores this container may use into one contiguous slice per worker, so torch's intra-op threads in
+    # different workers don't fight over the same cores
+    cpus = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cpus) // server.cfg.workers)
+    index = (worker.age - 1) % server.cfg.workers
+    start = (index * per_worker) % len(cpus)
+    pinned = cpus[start:start + per_worker]
+    os.sched_setaffinity(0, pinned)
+
+    import torch
+    torch.set_num_threads(len(pinned))
+    server.log.info(f'worker {worker.pid} pinned to cpus {pinned}')
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
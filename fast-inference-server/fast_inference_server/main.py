@@ -1,19 +1,50 @@
-import torch
-import ujson
+import asyncio
+import itertools
+import os
+import threading
+import time
+from functools import partial
+
 from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
 from starlette.routing import Route
 from starlette.endpoints import HTTPEndpoint
-from starlette.responses import PlainTextResponse
+from starlette.responses import PlainTextResponse, StreamingResponse
 
+from batching import MicroBatcher
+from cache import PredictionCache
+from executor import ExecutorSaturated, InferenceExecutor
+from metrics import (BATCH_ROWS, CACHE_HITS, CACHE_MISSES, DECODE_SECONDS, ENCODE_SECONDS, FORWARD_SECONDS, IN_FLIGHT,
+                     INFERENCE_SECONDS, MODEL_LOAD_SECONDS, RECEIVE_SECONDS, REQUESTS, Metrics)
+from models import ARTIFACT_SUFFIX, load_artifact, load_model, prepare_model
+from payloads import (OCTET_STREAM, PayloadError, accepted_media_type, decode_request, encode_response,
+                      media_type)
+from registry import ModelNotFound, ModelRegistry
+from streaming import NDJSON, encode_frame, encode_ndjson, frame_chunks, ndjson_chunks
 
-class LinearRegression(torch.nn.Module):
-    def __init__(self, inputSize, outputSize):
-        super(LinearRegression, self).__init__()
-        self.linear = torch.nn.Linear(inputSize, outputSize)
 
-    def forward(self, x):
-        out = self.linear(x)
-        return out
+MODEL_DIR = os.environ.get('MODEL_DIR', '/opt/app-root/models')
+DEFAULT_MODEL = os.environ.get('DEFAULT_MODEL', 'model')
+PRELOAD_MODELS = [name for name in os.environ.get('PRELOAD_MODELS', DEFAULT_MODEL).split(',') if name]
+PRELOAD_IN_BACKGROUND = os.environ.get('PRELOAD_IN_BACKGROUND', '0') == '1'
+MAX_MODELS = int(os.environ.get('MAX_MODELS', '16'))
+MAX_MODEL_BYTES = int(os.environ['MAX_MODEL_BYTES']) if os.environ.get('MAX_MODEL_BYTES') else None
+MODEL_POLL_INTERVAL = float(os.environ.get('MODEL_POLL_INTERVAL', '5'))
+MODEL_MODE = os.environ.get('MODEL_MODE', 'eager')
+MODEL_MMAP = os.environ.get('MODEL_MMAP', '0') == '1'
+WARMUP_BATCH_SIZES = [int(size) for size in os.environ.get('WARMUP_BATCH_SIZES', '1,8,64').split(',') if size]
+BATCHING_ENABLED = os.environ.get('BATCHING_ENABLED', '0') == '1'
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '64'))
+BATCH_MAX_WAIT_US = int(os.environ.get('BATCH_MAX_WAIT_US', '500'))
+BATCH_MAX_QUEUE = int(os.environ.get('BATCH_MAX_QUEUE', '1024'))
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', '1'))
+INFERENCE_MAX_PENDING = int(os.environ.get('INFERENCE_MAX_PENDING', '64'))
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', '0') == '1'
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '10000'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CACHE_TTL_SECONDS = float(os.environ['CACHE_TTL_SECONDS']) if os.environ.get('CACHE_TTL_SECONDS') else None
+STREAM_CHUNK_ROWS = int(os.environ.get('STREAM_CHUNK_ROWS', '1024'))
+TORCH_INTRA_OP_THREADS = int(os.environ['TORCH_INTRA_OP_THREADS']) if os.environ.get('TORCH_INTRA_OP_THREADS') else None
 
 
 class HealthCheck(HTTPEndpoint):
@@ -21,23 +52,210 @@ class HealthCheck(HTTPEndpoint):
         return PlainTextResponse("0")
 
 
+class Readiness(HTTPEndpoint):
+    async def get(self, request):
+        if ready.is_set():
+            return PlainTextResponse("0")
+        return PlainTextResponse("loading models", status_code=503)
+
+
 class Prediction(HTTPEndpoint):
     async def post(self, request):
-        data = await self.receive()
-        tensor = torch.Tensor(ujson.loads(data['body']))
-        return PlainTextResponse(f"{model(tensor).data.numpy()}")
+        name = request.path_params.get('model_name', DEFAULT_MODEL)
+        IN_FLIGHT.inc()
+        try:
+            response = await self.predict(request, name)
+        finally:
+            IN_FLIGHT.dec()
+        # don't let arbitrary model names in urls create new label values
+        REQUESTS.labels(name if response.status_code != 404 else 'unknown', response.status_code).inc()
+        return response
+
+    async def predict(self, request, name):
+        try:
+            served = await get_model(name)
+        except ModelNotFound:
+            return PlainTextResponse(f"unknown model: {name}", status_code=404)
+        start = time.perf_counter()
+        body = await request.body()
+        received = time.perf_counter()
+        RECEIVE_SECONDS.observe(received - start)
+        content_type = media_type(request.headers.get('content-type'))
+        accept = accepted_media_type(request.headers.get('accept'))
+        if cache is not None:
+            cache_key = cache.key(served, body, content_type, accept)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                CACHE_HITS.inc()
+                return cached
+            CACHE_MISSES.inc()
+        try:
+            tensor = decode_request(body, content_type, n_features=served.model.in_features)
+        except PayloadError as e:
+            return PlainTextResponse(str(e), status_code=400)
+        decoded = time.perf_counter()
+        DECODE_SECONDS.observe(decoded - received)
+        try:
+            out = await predict(served, tensor)
+        except ExecutorSaturated:
+            return unavailable(f"inference queue is full, {executor.pending} calls pending")
+        except asyncio.QueueFull:
+            return unavailable(f"batch queue is full, {batchers[served.name].pending} requests waiting")
+        predicted = time.perf_counter()
+        INFERENCE_SECONDS.observe(predicted - decoded)
+        response = encode_response(out, accept)
+        ENCODE_SECONDS.observe(time.perf_counter() - predicted)
+        if cache is not None:
+            # responses are never modified once built, so the same one can be sent again
+            cache.put(cache_key, response)
+        return response
+
+
+class StreamingPrediction(HTTPEndpoint):
+    """Scores a stream of rows, predictions are streamed back chunk by chunk while the body is still being read.
+
+    The body is either newline delimited json, one row per line, or length prefixed frames of float32 rows; the
+    response uses the same format.
+    """
+
+    async def post(self, request):
+        name = request.path_params.get('model_name', DEFAULT_MODEL)
+        try:
+            served = await get_model(name)
+        except ModelNotFound:
+            REQUESTS.labels('unknown', 404).inc()
+            return PlainTextResponse(f"unknown model: {name}", status_code=404)
+        REQUESTS.labels(name, 200).inc()
+        # starlette 0.13's StreamingResponse doesn't read from the connection, so the body can still be read while
+        # the response is being sent
+        if media_type(request.headers.get('content-type')) == OCTET_STREAM:
+            chunks = frame_chunks(request.stream(), served.model.in_features, STREAM_CHUNK_ROWS)
+            return StreamingResponse(self.predictions(served, chunks, encode_frame), media_type=OCTET_STREAM)
+        chunks = ndjson_chunks(request.stream(), served.model.in_features, STREAM_CHUNK_ROWS)
+        return StreamingResponse(self.predictions(served, chunks, encode_ndjson), media_type=NDJSON)
+
+    async def predictions(self, served, chunks, encode):
+        IN_FLIGHT.inc()
+        try:
+            async for tensor in chunks:
+                yield encode(await self.forward(served, tensor))
+        except PayloadError as e:
+            # the status line is long gone, all that's left is to cut the response short
+            print(f'aborting prediction stream: {e}', flush=True)
+            raise
+        finally:
+            IN_FLIGHT.dec()
+
+    async def forward(self, served, tensor):
+        # a stream has already answered 200, wait for the executor to free up instead of failing part way through
+        for attempt in itertools.count(1):
+            try:
+                return await executor.run(forward, served.model, tensor)
+            except ExecutorSaturated:
+                await asyncio.sleep(min(0.001 * attempt, 0.05))
+
+
+def unavailable(message):
+    return PlainTextResponse(message, status_code=503, headers={'Retry-After': '1'})
+
+
+async def get_model(name):
+    served = registry.get_nowait(name)
+    if served is None:
+        # loading reads from disk, keep it off the event loop
+        served = await run_in_threadpool(registry.get, name)
+    return served
 
 
-def load_model():
-    model_file = '/opt/app-root/models/model.torch'
-    print(f'loading model from: {model_file}', flush=True)
-    model = LinearRegression(1, 1)
-    model.load_state_dict(torch.load(model_file))
+async def predict(served, tensor):
+    if not BATCHING_ENABLED:
+        return await executor.run(forward, served.model, tensor)
+    batcher = batchers.get(served.name)
+    if batcher is None:
+        batcher = MicroBatcher(partial(run_batch, served.name),
+                               max_batch_size=BATCH_MAX_SIZE,
+                               max_wait_us=BATCH_MAX_WAIT_US,
+                               max_concurrent_batches=INFERENCE_WORKERS,
+                               max_queue=BATCH_MAX_QUEUE)
+        await batcher.start()
+        batchers[served.name] = batcher
+    return await batcher.predict(tensor)
+
+
+async def run_batch(name, tensor):
+    # look the model up per batch so reloads and evictions are picked up
+    served = await get_model(name)
+    BATCH_ROWS.observe(tensor.shape[0])
+    return await executor.run(forward, served.model, tensor)
+
+
+def forward(model, tensor):
+    start = time.perf_counter()
+    out = model(tensor)
+    FORWARD_SECONDS.observe(time.perf_counter() - start)
+    return out
+
+
+def load(path):
+    start = time.perf_counter()
+    if path.endswith(ARTIFACT_SUFFIX):
+        model = load_artifact(path, warmup_batch_sizes=WARMUP_BATCH_SIZES)
+    else:
+        model = prepare_model(load_model(path, mmap=MODEL_MMAP), mode=MODEL_MODE, warmup_batch_sizes=WARMUP_BATCH_SIZES)
+    MODEL_LOAD_SECONDS.labels(os.path.splitext(os.path.basename(path))[0]).observe(time.perf_counter() - start)
     return model
 
 
 print(f'loading....', flush=True)
-model = load_model()
+cache = PredictionCache(max_entries=CACHE_MAX_ENTRIES,
+                        max_bytes=CACHE_MAX_BYTES,
+                        ttl=CACHE_TTL_SECONDS) if CACHE_ENABLED else None
+registry = ModelRegistry(MODEL_DIR,
+                         load,
+                         suffixes=(ARTIFACT_SUFFIX, '.torch'),
+                         max_models=MAX_MODELS,
+                         max_bytes=MAX_MODEL_BYTES,
+                         poll_interval=MODEL_POLL_INTERVAL,
+                         on_unload=cache.invalidate if cache is not None else None)
+ready = threading.Event()
+
+
+def preload():
+    start = time.perf_counter()
+    for model_name in PRELOAD_MODELS:
+        registry.get(model_name)
+    print(f'loaded and warmed up {PRELOAD_MODELS} in {time.perf_counter() - start:.2f}s', flush=True)
+    ready.set()
+
+
+if not PRELOAD_IN_BACKGROUND:
+    preload()
+executor = InferenceExecutor(workers=INFERENCE_WORKERS,
+                             intra_op_threads=TORCH_INTRA_OP_THREADS,
+                             max_pending=INFERENCE_MAX_PENDING)
+batchers = {}
+
+
+async def startup():
+    executor.start()
+    registry.start()
+    if PRELOAD_IN_BACKGROUND:
+        # answer health checks right away, /ready flips once the models are warm
+        threading.Thread(target=preload, name='preload', daemon=True).start()
+
+
+async def shutdown():
+    for batcher in batchers.values():
+        await batcher.stop()
+    registry.stop()
+    executor.stop()
+
+
 routes = [Route("/", endpoint=HealthCheck),
-          Route("/predict", endpoint=Prediction)]
-app = Starlette(debug=True, routes=routes)
+          Route("/ready", endpoint=Readiness),
+          Route("/metrics", endpoint=Metrics),
+          Route("/predict", endpoint=Prediction),
+          Route("/predict/stream", endpoint=StreamingPrediction),
+          Route("/predict/{model_name}", endpoint=Prediction),
+          Route("/predict/{model_name}/stream", endpoint=StreamingPrediction)]
+app = Starlette(debug=True, routes=routes, on_startup=[startup], on_shutdown=[shutdown])
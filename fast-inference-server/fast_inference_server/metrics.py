@@ -0,0 +1,44 @@
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+from starlette.endpoints import HTTPEndpoint
+from starlette.responses import Response
+
+
+# sub millisecond resolution, the whole request budget is ~50ms
+LATENCY_BUCKETS = (.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+ROW_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+REQUESTS = Counter('predict_requests_total', 'Prediction requests', ['model', 'status'])
+IN_FLIGHT = Gauge('predict_requests_in_flight', 'Prediction requests being served', multiprocess_mode='livesum')
+STAGE_SECONDS = Histogram('predict_stage_seconds', 'Time spent in each stage of a prediction request', ['stage'],
+                          buckets=LATENCY_BUCKETS)
+BATCH_ROWS = Histogram('predict_batch_rows', 'Rows per forward pass of the micro batcher', buckets=ROW_BUCKETS)
+CACHE_REQUESTS = Counter('prediction_cache_requests_total', 'Prediction cache lookups', ['result'])
+MODEL_LOAD_SECONDS = Histogram('model_load_seconds', 'Time to load and prepare a model', ['model'],
+                               buckets=(.01, .05, .1, .5, 1.0, 5.0, 10.0, 30.0, 60.0))
+
+# resolve the labels once, looking them up per request is most of the cost of observing
+RECEIVE_SECONDS = STAGE_SECONDS.labels('receive')
+DECODE_SECONDS = STAGE_SECONDS.labels('decode')
+INFERENCE_SECONDS = STAGE_SECONDS.labels('inference')
+FORWARD_SECONDS = STAGE_SECONDS.labels('forward')
+ENCODE_SECONDS = STAGE_SECONDS.labels('encode')
+CACHE_HITS = CACHE_REQUESTS.labels('hit')
+CACHE_MISSES = CACHE_REQUESTS.labels('miss')
+
+
+def _multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+
+
+class Metrics(HTTPEndpoint):
+    async def get(self, request):
+        if _multiprocess_dir():
+            # every gunicorn worker writes its own files, aggregate them on each scrape
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,107 @@
+import inspect
+import json
+import time
+
+import torch
+
+
+MODES = ('eager', 'script', 'freeze')
+ARTIFACT_SUFFIX = '.ts'
+ARTIFACT_META = 'meta.json'
+
+# torch.inference_mode only exists from torch 1.9 onwards
+_inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+# torch.load(mmap=True) and load_state_dict(assign=True) only exist from torch 2.1 onwards
+_supports_mmap = 'mmap' in inspect.signature(torch.load).parameters
+
+
+class LinearRegression(torch.nn.Module):
+    def __init__(self, inputSize, outputSize):
+        super(LinearRegression, self).__init__()
+        self.linear = torch.nn.Linear(inputSize, outputSize)
+
+    def forward(self, x):
+        out = self.linear(x)
+        return out
+
+
+class InferenceModel:
+    """A model prepared for serving, calls run without autograd bookkeeping."""
+
+    def __init__(self, module, in_features, out_features, mode, nbytes):
+        self.module = module
+        self.in_features = in_features
+        self.out_features = out_features
+        self.mode = mode
+        self.nbytes = nbytes
+
+    def __call__(self, tensor):
+        with _inference_mode():
+            return self.module(tensor)
+
+
+def load_model(model_file, mmap=False):
+    """Loads a `LinearRegression` state dict.
+
+    With `mmap` the weights stay backed by the memory mapped file, so every process serving the same file shares one
+    copy of them through the page cache.
+    """
+    print(f'loading model from: {model_file}', flush=True)
+    if mmap and not _supports_mmap:
+        print(f'torch {torch.__version__} can not memory map model files, loading into memory', flush=True)
+        mmap = False
+    if mmap:
+        state_dict = torch.load(model_file, map_location='cpu', mmap=True)
+    else:
+        state_dict = torch.load(model_file)
+    out_features, in_features = state_dict['linear.weight'].shape
+    model = LinearRegression(in_features, out_features)
+    if mmap:
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model.load_state_dict(state_dict)
+    return model
+
+
+def prepare_model(model, mode='eager', warmup_batch_sizes=(1,)):
+    if mode not in MODES:
+        raise ValueError(f'unknown model mode: {mode}, expected one of {MODES}')
+    in_features, out_features = model.linear.in_features, model.linear.out_features
+    nbytes = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    model.eval()
+    module = model
+    if mode in ('script', 'freeze'):
+        module = torch.jit.script(model)
+    if mode == 'freeze':
+        module = torch.jit.freeze(module)
+    return warm_up(InferenceModel(module, in_features, out_features, mode, nbytes), warmup_batch_sizes)
+
+
+def warm_up(prepared, warmup_batch_sizes):
+    start = time.perf_counter()
+    for batch_size in warmup_batch_sizes:
+        prepared(torch.zeros(batch_size, prepared.in_features))
+    print(f'prepared {prepared.mode} model, warm up with batch sizes {list(warmup_batch_sizes)} '
+          f'took {(time.perf_counter() - start) * 1000:.1f}ms', flush=True)
+    return prepared
+
+
+def export_model(prepared, artifact_file):
+    """Saves a scripted or frozen model as a TorchScript archive that `load_artifact` can serve as is."""
+    if prepared.mode == 'eager':
+        raise ValueError('only script and freeze models can be exported')
+    meta = dict(in_features=prepared.in_features,
+                out_features=prepared.out_features,
+                mode=prepared.mode,
+                nbytes=prepared.nbytes)
+    torch.jit.save(prepared.module, artifact_file, _extra_files={ARTIFACT_META: json.dumps(meta)})
+
+
+def load_artifact(artifact_file, warmup_batch_sizes=(1,)):
+    """Loads a TorchScript archive written by `export_model`, skipping the model rebuild and compilation."""
+    print(f'loading model artifact from: {artifact_file}', flush=True)
+    extra_files = {ARTIFACT_META: ''}
+    module = torch.jit.load(artifact_file, map_location='cpu', _extra_files=extra_files)
+    meta = json.loads(extra_files[ARTIFACT_META])
+    prepared = InferenceModel(module, meta['in_features'], meta['out_features'], meta['mode'], meta['nbytes'])
+    return warm_up(prepared, warmup_batch_sizes)
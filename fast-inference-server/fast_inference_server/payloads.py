@@ -0,0 +1,168 @@
+import io
+import warnings
+
+import numpy as np
+import torch
+import ujson
+from starlette.responses import Response
+
+
+OCTET_STREAM = 'application/octet-stream'
+NPY = 'application/x-npy'
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+JSON = 'application/json'
+
+# request bodies arrive as immutable bytes, tensors built on top of them are only ever read
+warnings.filterwarnings('ignore', message='The given NumPy array is not writ')
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def media_type(header):
+    return (header or '').split(';')[0].strip().lower()
+
+
+def decode_request(body, content_type, n_features):
+    """Decodes a request body into a row, or a 2-d batch of rows, of `n_features` float32 values."""
+    content_type = media_type(content_type)
+    if content_type == OCTET_STREAM:
+        tensor = _decode_raw(body, n_features)
+    elif content_type == NPY:
+        tensor = _decode_npy(body)
+    elif content_type == ARROW_STREAM:
+        tensor = _decode_arrow(body)
+    else:
+        tensor = _decode_json(body)
+    return check_shape(tensor, n_features)
+
+
+def check_shape(tensor, n_features):
+    # anything else would fail inside the model, or in a batch it shares with other requests
+    if tensor.dim() not in (1, 2) or tensor.shape[-1] != n_features:
+        raise PayloadError(f'expected a row or rows of {n_features} features, got shape {tuple(tensor.shape)}')
+    return tensor
+
+
+def _decode_json(body):
+    try:
+        data = ujson.loads(body)
+    except ValueError as e:
+        raise PayloadError(f'invalid json payload: {e}')
+    # torch.Tensor(3) would be an uninitialized tensor of 3 values rather than the number 3
+    if not isinstance(data, list):
+        raise PayloadError('json payload must be a list of numbers or a list of rows')
+    try:
+        return torch.Tensor(data)
+    except (ValueError, TypeError) as e:
+        raise PayloadError(f'invalid json payload: {e}')
+
+
+def _decode_raw(body, n_features):
+    row_bytes = 4 * n_features
+    if len(body) == 0 or len(body) % row_bytes:
+        raise PayloadError(f'raw payload of {len(body)} bytes is not a whole number of {n_features} float32 rows')
+    return torch.from_numpy(np.frombuffer(body, dtype='<f4').reshape(-1, n_features))
+
+
+def _decode_npy(body):
+    stream = io.BytesIO(body)
+    try:
+        version = np.lib.format.read_magic(stream)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+        else:
+            raise PayloadError(f'unsupported npy version: {version}')
+        array = np.frombuffer(body, dtype=dtype, count=int(np.prod(shape)), offset=stream.tell())
+    except ValueError as e:
+        raise PayloadError(f'invalid npy payload: {e}')
+    if dtype.hasobject:
+        raise PayloadError('npy payloads may not contain python objects')
+    if dtype.kind not in 'biuf':
+        raise PayloadError(f'npy payload must be numeric, got dtype {dtype}')
+    array = array.reshape(shape, order='F' if fortran_order else 'C')
+    return torch.from_numpy(array.astype(np.float32, copy=False))
+
+
+def _decode_arrow(body):
+    # pyarrow is optional and slow to import, only pay for it once an arrow payload shows up
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise PayloadError('arrow payloads require pyarrow to be installed')
+    try:
+        table = pyarrow.ipc.open_stream(body).read_all()
+    except pyarrow.ArrowInvalid as e:
+        raise PayloadError(f'invalid arrow payload: {e}')
+    types = table.schema.types
+    if len(types) == 1 and pyarrow.types.is_fixed_size_list(types[0]):
+        # one fixed size list column per row is already laid out row major
+        if not _is_numeric_arrow(types[0].value_type):
+            raise PayloadError(f'arrow payload must be numeric, got a column of {types[0]}')
+        column = table.column(0).combine_chunks()
+        array = column.flatten().to_numpy(zero_copy_only=False).reshape(-1, types[0].list_size)
+    else:
+        if not types or not all(_is_numeric_arrow(t) for t in types):
+            raise PayloadError(f'arrow payload must be numeric columns or one fixed size list column, got '
+                               f'{", ".join(str(t) for t in types) or "no columns"}')
+        array = np.column_stack([column.to_numpy() for column in table.columns])
+    return torch.from_numpy(array.astype(np.float32, copy=False))
+
+
+def _is_numeric_arrow(arrow_type):
+    import pyarrow
+    return pyarrow.types.is_integer(arrow_type) or pyarrow.types.is_floating(arrow_type)
+
+
+def accepted_media_type(header):
+    """Returns the supported response media type the client prefers, falling back to json."""
+    candidates = []
+    for i, part in enumerate((header or '').split(',')):
+        params = part.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        candidates.append((-quality, i, media_type(params[0])))
+    for quality, _, candidate in sorted(candidates):
+        if quality < 0 and candidate in _ENCODERS:
+            return candidate
+    return JSON
+
+
+def encode_response(tensor, accept):
+    media = accepted_media_type(accept)
+    array = tensor.detach().numpy()
+    return Response(_ENCODERS[media](array),
+                    media_type=media,
+                    headers={'X-Shape': ','.join(str(d) for d in array.shape)})
+
+
+def _encode_json(array):
+    return ujson.dumps(array.tolist())
+
+
+def _encode_raw(array):
+    return array.astype('<f4', copy=False).tobytes()
+
+
+def _encode_npy(array):
+    array = np.ascontiguousarray(array.astype('<f4', copy=False))
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(array))
+    return header.getvalue() + array.tobytes()
+
+
+_ENCODERS = {
+    JSON: _encode_json,
+    OCTET_STREAM: _encode_raw,
+    NPY: _encode_npy,
+}
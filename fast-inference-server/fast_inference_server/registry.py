@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ModelNotFound(KeyError):
+    pass
+
+
+class ServedModel:
+    def __init__(self, name, path, model, version, load_seconds):
+        self.name = name
+        self.path = path
+        self.model = model
+        self.version = version
+        self.load_seconds = load_seconds
+
+
+class ModelRegistry:
+    """Loads models from `<model_dir>/<name><suffix>` on first use and keeps the most recently used ones resident.
+
+    At most `max_models` models, and at most `max_bytes` bytes of weights when set, stay loaded; the least recently
+    used are evicted past that. A background thread polls the files of resident models every `poll_interval` seconds
+    and swaps in a freshly loaded model when one changes on disk. `on_unload` is called with the model's name whenever
+    a model is evicted or replaced by a reload.
+    """
+
+    def __init__(self, model_dir, load, suffixes=('.torch',), max_models=16, max_bytes=None, poll_interval=5.0,
+                 on_unload=None):
+        self.model_dir = model_dir
+        self.load = load
+        self.on_unload = on_unload
+        self.suffixes = suffixes
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._failed_versions = {}
+        self._stopped = threading.Event()
+        self._watcher = None
+
+    def path(self, name):
+        if not name or name != os.path.basename(name) or name.startswith('.'):
+            raise ModelNotFound(name)
+        # the first suffix with a file on disk wins
+        paths = [os.path.join(self.model_dir, name + suffix) for suffix in self.suffixes]
+        return next((path for path in paths if os.path.exists(path)), paths[0])
+
+    def get_nowait(self, name):
+        with self._lock:
+            served = self._models.get(name)
+            if served is not None:
+                self._models.move_to_end(name)
+            return served
+
+    def get(self, name):
+        served = self.get_nowait(name)
+        if served is not None:
+            return served
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            # another thread may have loaded it while we waited
+            served = self.get_nowait(name)
+            if served is None:
+                try:
+                    served = self._load(name)
+                except ModelNotFound:
+                    # unknown names come straight from urls, don't keep a lock around for each of them
+                    with self._lock:
+                        self._load_locks.pop(name, None)
+                    raise
+                self._put(served)
+            return served
+
+    def resident(self):
+        with self._lock:
+            return list(self._models.values())
+
+    def start(self):
+        self._stopped.clear()
+        self._watcher = threading.Thread(target=self._watch, name='model-watcher', daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _load(self, name):
+        path = self.path(name)
+        try:
+            version = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            raise ModelNotFound(name)
+        start = time.perf_counter()
+        model = self.load(path)
+        return ServedModel(name, path, model, version, time.perf_counter() - start)
+
+    def _put(self, served):
+        with self._lock:
+            self._models[served.name] = served
+            self._models.move_to_end(served.name)
+            while len(self._models) > 1 and (len(self._models) > self.max_models or self._over_bytes()):
+                name, _ = self._models.popitem(last=False)
+                print(f'evicted model: {name}', flush=True)
+                if self.on_unload is not None:
+                    self.on_unload(name)
+
+    def _over_bytes(self):
+        return self.max_bytes is not None and sum(s.model.nbytes for s in self._models.values()) > self.max_bytes
+
+    def _watch(self):
+        while not self._stopped.wait(self.poll_interval):
+            for served in self.resident():
+                try:
+                    version = os.stat(served.path).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                if version == served.version or version == self._failed_versions.get(served.name):
+                    continue
+                print(f'model file changed, reloading: {served.path}', flush=True)
+                try:
+                    reloaded = self._load(served.name)
+                except Exception as e:
+                    print(f'failed to reload {served.path}: {e}', flush=True)
+                    self._failed_versions[served.name] = version
+                    continue
+                with self._lock:
+                    # only swap if the model was not evicted while it reloaded
+                    if served.name not in self._models:
+                        continue
+                    self._models[served.name] = reloaded
+                if self.on_unload is not None:
+                    self.on_unload(served.name)
@@ -0,0 +1,89 @@
+import struct
+
+import torch
+import ujson
+
+from payloads import OCTET_STREAM, PayloadError, check_shape, decode_request
+
+
+NDJSON = 'application/x-ndjson'
+FRAME_HEADER = struct.Struct('<I')
+
+
+async def ndjson_chunks(stream, n_features, chunk_rows):
+    """Parses a newline delimited json body, one row per line, into tensors of at most `chunk_rows` rows.
+
+    Every line has to be a json list of `n_features` numbers.
+    """
+    buffer = b''
+    rows = []
+    async for chunk in stream:
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                rows.append(_parse_line(line, n_features))
+            if len(rows) == chunk_rows:
+                yield _to_tensor(rows, n_features)
+                rows = []
+    if buffer.strip():
+        rows.append(_parse_line(buffer, n_features))
+    if rows:
+        yield _to_tensor(rows, n_features)
+
+
+def _parse_line(line, n_features):
+    try:
+        row = ujson.loads(line)
+    except ValueError as e:
+        raise PayloadError(f'invalid json line: {e}')
+    if not isinstance(row, list) or len(row) != n_features:
+        raise PayloadError(f'every line must be a list of {n_features} numbers, got {line[:100]!r}')
+    return row
+
+
+def _to_tensor(rows, n_features):
+    try:
+        tensor = torch.Tensor(rows)
+    except (ValueError, TypeError) as e:
+        raise PayloadError(f'invalid json line: {e}')
+    # rows of nested lists have the right length but come out with more dimensions
+    return check_shape(tensor, n_features)
+
+
+async def frame_chunks(stream, n_features, chunk_rows):
+    """Parses a body of length prefixed frames into tensors of about `chunk_rows` rows.
+
+    Every frame is a little-endian uint32 byte count followed by that many bytes of little-endian float32 rows.
+    """
+    buffer = bytearray()
+    frames, rows = [], 0
+    async for chunk in stream:
+        buffer += chunk
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + FRAME_HEADER.size + length
+            if len(buffer) < end:
+                break
+            frame = decode_request(bytes(buffer[offset + FRAME_HEADER.size:end]), OCTET_STREAM, n_features)
+            frames.append(frame)
+            rows += frame.shape[0]
+            offset = end
+            if rows >= chunk_rows:
+                yield torch.cat(frames)
+                frames, rows = [], 0
+        del buffer[:offset]
+    if buffer:
+        raise PayloadError(f'body ended in the middle of a frame, {len(buffer)} bytes left over')
+    if frames:
+        yield torch.cat(frames)
+
+
+def encode_ndjson(tensor):
+    return ''.join(ujson.dumps(row) + '\n' for row in tensor.detach().tolist())
+
+
+def encode_frame(tensor):
+    data = tensor.detach().numpy().astype('<f4', copy=False).tobytes()
+    return FRAME_HEADER.pack(len(data)) + data
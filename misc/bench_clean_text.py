@@ -0,0 +1,82 @@
+import argparse
+import logging
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from update_elasticsearch import TEXT_COLUMNS, clean_text
+
+
+formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(funcName)s  | %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+WORDS = ['device', 'patient', 'reported', 'failure', 'catheter', 'pump', 'alarm', 'café', 'naïve', 'µg', '°C',
+         '–', '’', 'implant', 'lead', 'battery']
+
+
+def make_records(rows, seed=0):
+    """A frame shaped like the INDEX_CREATION_QUERY result, with a sprinkling of non-ascii characters."""
+    rng = np.random.default_rng(seed)
+    words = np.array(WORDS, dtype=object)
+
+    def text(n_words):
+        return [' '.join(row) for row in words[rng.integers(0, len(words), size=(rows, n_words))]]
+
+    df = pd.DataFrame({
+        'mdr_report_key': rng.integers(1, 10 ** 8, size=rows),
+        'report_date': pd.Timestamp('2021-03-01') + pd.to_timedelta(rng.integers(0, 30, size=rows), unit='D'),
+        'foi_text': text(60),
+        'brand_name': text(2),
+        'generic_name': text(2),
+        'model_number': text(1),
+        'catalog_number': text(1),
+        'manufacturer_name': text(2),
+        'event_location': text(1),
+        'device_operator': text(1),
+    })
+    df['device_text'] = df.manufacturer_name + ' ' + df.brand_name + ' ' + df.generic_name
+    df['index_id'] = df.mdr_report_key.astype(str) + '|1|1|1'
+    return df
+
+
+def timed(name, fn, df, repeat):
+    best = None
+    for _ in range(repeat):
+        frame = df.copy()
+        start = time.perf_counter()
+        fn(frame)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    logger.info(f'{name:>28}: {best:.3f}s, {len(df) / best:,.0f} rows/s')
+    return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare the DataFrame wide regex replace with clean_text")
+    parser.add_argument("--rows", type=int, help="rows in the synthetic frame", default=100000)
+    parser.add_argument("--workers", type=int, help="processes for the parallel run", default=4)
+    parser.add_argument("--repeat", type=int, help="runs per approach, the best is reported", default=3)
+    args = parser.parse_args()
+
+    df = make_records(args.rows)
+    logger.info(f'cleaning {args.rows} rows')
+    expected = timed('df.replace regex, all columns',
+                     lambda f: f.replace({r'[^\x00-\x7F]+': ''}, regex=True, inplace=True),
+                     df,
+                     args.repeat)
+    for name, workers in [('clean_text', 1), (f'clean_text, {args.workers} workers', args.workers)]:
+        cleaned = timed(name, lambda f: clean_text(f, workers=workers), df, args.repeat)
+        columns = [c for c in TEXT_COLUMNS if c in df.columns]
+        if not cleaned[columns].equals(expected[columns]):
+            raise AssertionError(f'{name} does not match the regex replace')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
 import argparse
+import heapq
 import logging
+import multiprocessing
+import posixpath
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-from pyspark.sql import SparkSession
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+from pyarrow.fs import FileSelector, FileSystem, FileType
 
 
 formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(funcName)s  | %(message)s')
@@ -13,6 +19,11 @@ console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+# inputs up to this many bytes of parquet are converted locally with --engine auto, bigger ones go to spark
+LOCAL_MAX_BYTES = 20 * 1024 ** 3
+# headerless, like spark's write.csv
+CSV_WRITE_OPTIONS = pa_csv.WriteOptions(include_header=False)
+
 
 def write_manifest(_df, _data_set, label='clicked'):
     meta_data = dict(columns=_df.columns,
@@ -20,6 +31,106 @@ def write_manifest(_df, _data_set, label='clicked'):
                      rows=_df.count())
 
 
+def list_parquet_files(fs, path):
+    """The data files under path, skipping the _SUCCESS markers and hidden files spark and others leave behind."""
+    infos = fs.get_file_info(FileSelector(path, recursive=True))
+    return [info for info in infos
+            if info.type == FileType.File and not info.base_name.startswith(('_', '.'))]
+
+
+def read_dataset(fs, path):
+    """The parquet dataset under path, with the columns of hive style k=v directories added like spark reads them."""
+    return ds.dataset(path, filesystem=fs, format='parquet', partitioning='hive')
+
+
+def plan_output_files(fragments, n_outputs):
+    """Splits the row groups of the parquet fragments into at most n_outputs lists of about the same size.
+
+    Every list is [(path, partition expression, [row group ids])] and becomes one csv file, so a few big input files
+    are split across workers just like many small ones.
+    """
+    row_groups, partitions = [], {}
+    for fragment in fragments:
+        partitions[fragment.path] = fragment.partition_expression
+        row_groups += [(row_group.total_byte_size, fragment.path, row_group.id) for row_group in fragment.row_groups]
+
+    # biggest row groups first, each into the output holding the fewest bytes so far
+    outputs = [(0, i, {}) for i in range(min(n_outputs, len(row_groups)))]
+    for size, path, i in sorted(row_groups, key=lambda r: r[0], reverse=True):
+        total, n, parts = heapq.heappop(outputs)
+        parts.setdefault(path, []).append(i)
+        heapq.heappush(outputs, (total + size, n, parts))
+    return [[(path, partitions[path], sorted(ids)) for path, ids in parts.items()] for _, _, parts in sorted(outputs)]
+
+
+def write_csv_part(fs, schema, parts, output_fs, output_path, batch_size=65536):
+    """Streams the row groups in parts into the csv file output_path, one batch at a time; returns the rows.
+
+    Batches are read with the dataset's schema, which fills in the partition columns from each file's expression.
+    """
+    rows = 0
+    parquet_format = ds.ParquetFileFormat()
+    with output_fs.open_output_stream(output_path) as out:
+        with pa_csv.CSVWriter(out, schema, write_options=CSV_WRITE_OPTIONS) as writer:
+            for path, partition_expression, row_groups in parts:
+                fragment = parquet_format.make_fragment(path, filesystem=fs, partition_expression=partition_expression,
+                                                        row_groups=row_groups)
+                for batch in fragment.to_batches(schema=schema, batch_size=batch_size):
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+    return rows
+
+
+def convert_locally(input_path, output_path, n_outputs=32, workers=None):
+    """Converts the parquet files under input_path to n_outputs csv files under output_path with pyarrow.
+
+    Each output file is written by its own task in a process pool of `workers` processes, all cpus by default.
+    """
+    fs, input_dir = FileSystem.from_uri(input_path)
+    output_fs, output_dir = FileSystem.from_uri(output_path)
+    dataset = read_dataset(fs, input_dir)
+    fragments = list(dataset.get_fragments())
+    plan = plan_output_files(fragments, n_outputs)
+    logger.warning(f'writing {len(fragments)} parquet files to {len(plan)} csv files in {output_path}')
+
+    # mode='overwrite', like the spark job
+    output_fs.create_dir(output_dir)
+    output_fs.delete_dir_contents(output_dir)
+    # spawned rather than forked workers, the S3 client in this process is not fork safe
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(write_csv_part, fs, dataset.schema, parts, output_fs,
+                               posixpath.join(output_dir, f'part-{i:05d}.csv'))
+                   for i, parts in enumerate(plan)]
+        rows = sum(future.result() for future in futures)
+    logger.warning(f'wrote {rows} rows')
+    return rows
+
+
+def convert_with_spark(input_path, output_path, n_outputs=32):
+    # imported here, so the local engine runs without pyspark and without starting a JVM
+    from pyspark.sql import SparkSession
+
+    spark = SparkSession.builder \
+        .appName("convert_parquet_data_to_csv") \
+        .getOrCreate()
+
+    logger.warning(f'reading parquet files in {input_path} to spark data frame')
+    df = spark.read.parquet(input_path)
+    logger.warning(f'writing dataframe to {output_path} as csv')
+    df.repartition(n_outputs).write.csv(output_path, mode='overwrite')
+
+    spark.stop()
+
+
+def choose_engine(input_path, local_max_bytes=LOCAL_MAX_BYTES):
+    fs, input_dir = FileSystem.from_uri(input_path)
+    input_bytes = sum(f.size for f in list_parquet_files(fs, input_dir))
+    engine = 'local' if input_bytes <= local_max_bytes else 'spark'
+    logger.warning(f'{input_path} holds {input_bytes} bytes of parquet, converting with {engine}')
+    return engine
+
+
 def main():
     parser = argparse.ArgumentParser(description="app inputs and outputs")
     parser.add_argument("--input_bucket", type=str, help="s3 bucket where input data is stored",
@@ -30,15 +141,20 @@ def main():
                         default='')
     parser.add_argument("--output_prefix", type=str, help="s3 output location",
                         default='')
+    parser.add_argument("--engine", type=str, choices=['auto', 'local', 'spark'],
+                        help="local converts with pyarrow in a process pool, auto picks it for inputs up to "
+                             "--local_max_bytes", default='auto')
+    parser.add_argument("--local_max_bytes", type=int, help="largest input, in bytes, auto converts locally",
+                        default=LOCAL_MAX_BYTES)
+    parser.add_argument("--output_files", type=int, help="number of csv files to write",
+                        default=32)
+    parser.add_argument("--workers", type=int, help="processes for the local engine, all cpus by default",
+                        default=None)
     args = parser.parse_args()
 
     for arg in vars(args):
         logger.warning(f'{arg} - {getattr(args, arg)}')
 
-    spark = SparkSession.builder \
-        .appName("convert_parquet_data_to_csv") \
-        .getOrCreate()
-
     input_bucket = args.input_bucket
     input_prefix = args.input_prefix
     output_bucket = args.output_bucket
@@ -47,12 +163,13 @@ def main():
     input_path = f's3://{input_bucket}/{input_prefix}'
     output_path = f's3://{output_bucket}/{output_prefix}'
 
-    logger.warning(f'reading parquet files in {input_path} to spark data frame')
-    df = spark.read.parquet(input_path)
-    logger.warning(f'writing dataframe to {output_path} as csv')
-    df.repartition(32).write.csv(output_path, mode='overwrite')
-
-    spark.stop()
+    engine = args.engine
+    if engine == 'auto':
+        engine = choose_engine(input_path, args.local_max_bytes)
+    if engine == 'local':
+        convert_locally(input_path, output_path, n_outputs=args.output_files, workers=args.workers)
+    else:
+        convert_with_spark(input_path, output_path, n_outputs=args.output_files)
 
 
 if __name__ == '__main__':
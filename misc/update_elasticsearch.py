@@ -1,13 +1,24 @@
 import json
 import logging
-import pkg_resources
+import os
+import queue
+import random
 import sys
+import threading
+import time
+import weakref
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date
+from functools import lru_cache
+from importlib import resources
+from json.encoder import encode_basestring_ascii
 from math import ceil
 
-import numpy as np
 import pandas as pd
-from elasticsearch import Elasticsearch, helpers
-from elasticsearch.helpers import BulkIndexError
+from elasticsearch import Elasticsearch, RequestError, TransportError
+from sqlalchemy import create_engine, text
 
 
 logger = logging.getLogger(sys.argv[0])
@@ -27,7 +38,8 @@ INDEX_CREATION_QUERY = '''
             || ' ' || COALESCE(d.model_number, '') || ' ' || COALESCE(d.catalog_number, '') AS device_text,
         m.mdr_report_key || '|' || t.mdr_text_key || '|' || t.patient_sequence_number ||
             '|' || de.device_sequence_number AS index_id,
-        m.added_date
+        m.added_date,
+        m.change_date
     FROM
         master_record m INNER JOIN
         foi_text t ON m.mdr_report_key = t.mdr_report_key INNER JOIN
@@ -40,151 +52,869 @@ INDEX_CREATION_QUERY = '''
     WHERE
       {where}
 '''
+# denormalized INDEX_CREATION_QUERY rows, one per index_id, kept up to date by refresh_staging_table
+STAGING_TABLE = 'maude_text_staging'
+STAGING_COLUMNS = ('mdr_report_key', 'report_date', 'event_location', 'foi_text', 'device_operator', 'brand_name',
+                   'generic_name', 'model_number', 'catalog_number', 'manufacturer_name', 'device_text', 'index_id',
+                   'added_date', 'change_date')
+# aliased as m, so the where clauses written for INDEX_CREATION_QUERY work on it unchanged
+STAGED_QUERY = 'SELECT {columns} FROM {table} m WHERE {{where}}'.format(columns=', '.join(STAGING_COLUMNS),
+                                                                       table=STAGING_TABLE)
+# the free text columns of INDEX_CREATION_QUERY, the only ones that can hold non-ascii characters
+TEXT_COLUMNS = ('event_location', 'foi_text', 'device_operator', 'brand_name', 'generic_name', 'model_number',
+                'catalog_number', 'manufacturer_name', 'device_text', 'index_id')
+# a bulk action already serialized to its NDJSON header and source lines, see generate_data
+SerializedAction = namedtuple('SerializedAction', ['id', 'header', 'source'])
+# fraction of the serialized documents written to the log, e.g. 0.001 when debugging a load
+DOCUMENT_DUMP_RATE = 0.0
+# how documents are sent without bulk_options, the way helpers.bulk sent them before
+SINGLE_THREAD_BULK = {'thread_count': 1, 'chunk_size': 200, 'max_retries': 0, 'request_timeout': 60}
+# the index schemas ship as elastic_schema_6-x.json and elastic_schema_7-x.json in this package
+SCHEMA_PACKAGE = 'maude_etl'
+INDEX_TEMPLATE = 'maude-text'
+INDEX_PATTERN = 'maude-text-*'
+# clients install_index_template already installed the template through
+_templated_clients = weakref.WeakSet()
+# the handler the entry points log through, see _setup_logging
+_log_handler = None
 
 
-def get_new_records(start_date, end_date, conn):
-    where = f"m.added_date >= '{start_date.strftime('%Y-%m-%d')}' AND m.added_date < '{end_date.strftime('%Y-%m-%d')}'"
-    index_creation_query = INDEX_CREATION_QUERY.format(where=where)
-    logger.info('Querying MAUDE db for records created between {} and {}'.format(
-        start_date.strftime('%Y-%m-%d'),
-        end_date.strftime('%Y-%m-%d')))
+def clean_text(df, columns=TEXT_COLUMNS, workers=1):
+    """Strips non-ascii characters from the text columns of df, in place.
+
+    With workers > 1 the rows are split into that many chunks and cleaned in a process pool.
+    """
+    columns = [c for c in columns if c in df.columns and pd.api.types.is_string_dtype(df[c].dtype)]
+    if not columns:
+        return df
+    if workers > 1 and len(df) > workers:
+        size = ceil(len(df) / workers)
+        chunks = [df[columns].iloc[i:i + size] for i in range(0, len(df), size)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            df[columns] = pd.concat(pool.map(_strip_non_ascii, chunks))
+    else:
+        df[columns] = _strip_non_ascii(df[columns])
+    return df
+
+
+def _strip_non_ascii(df):
+    # encoding with errors='ignore' drops exactly the characters the old [^\x00-\x7F]+ regex removed
+    return df.apply(lambda column: column.str.encode('ascii', 'ignore').str.decode('ascii'))
 
+
+def get_new_records(start_date, end_date, conn, clean_workers=1, staged=False):
+    index_creation_query = _new_records_query(start_date, end_date, staged)
     df = pd.read_sql(index_creation_query, conn)
     logger.info('Found {} new records'.format(len(df)))
 
     if len(df) > 0:
-        logger.info('removing non-printing unicode characters')
-        df.replace({r'[^\x00-\x7F]+': ''}, regex=True, inplace=True)
-        df.drop(columns='added_date', inplace=True)
+        df = _clean_new_records(df, workers=clean_workers)
     else:
         df = None
 
     return df
 
 
-def get_changed_records(start_date, end_date, conn):
+def stream_new_records(start_date, end_date, conn, chunk_size=20000, staged=False):
+    """Like get_new_records, but yields the records chunk_size rows at a time from a server side cursor."""
+    index_creation_query = _new_records_query(start_date, end_date, staged)
+    total = 0
+    for df in _read_sql_chunks(index_creation_query, conn, chunk_size):
+        total += len(df)
+        logger.info('Read {} new records, {} so far'.format(len(df), total))
+        yield _clean_new_records(df)
+    logger.info('Found {} new records'.format(total))
+
+
+def _new_records_query(start_date, end_date, staged=False):
+    where = f"m.added_date >= '{start_date.strftime('%Y-%m-%d')}' AND m.added_date < '{end_date.strftime('%Y-%m-%d')}'"
+    logger.info('Querying MAUDE db for records created between {} and {}'.format(
+        start_date.strftime('%Y-%m-%d'),
+        end_date.strftime('%Y-%m-%d')))
+    return _records_query(staged).format(where=where)
+
+
+def _clean_new_records(df, workers=1):
+    logger.info('removing non-printing unicode characters')
+    clean_text(df, workers=workers)
+    df.drop(columns=['added_date', 'change_date'], inplace=True)
+    return df
+
+
+def get_changed_records(start_date, end_date, conn, clean_workers=1, staged=False):
+    index_creation_query = _changed_records_query(start_date, end_date, staged)
+    df = pd.read_sql(index_creation_query, conn)
+
+    logger.info('Found {} changed records'.format(len(df)))
+
+    if len(df) > 0:
+        return _split_changed_records(df, workers=clean_workers)
+
+    return None
+
+
+def stream_changed_records(start_date, end_date, conn, chunk_size=20000, staged=False):
+    """Like get_changed_records, but yields one {month: records} dict per chunk_size rows from a server side cursor."""
+    index_creation_query = _changed_records_query(start_date, end_date, staged)
+    total = 0
+    for df in _read_sql_chunks(index_creation_query, conn, chunk_size):
+        total += len(df)
+        logger.info('Read {} changed records, {} so far'.format(len(df), total))
+        yield _split_changed_records(df)
+    logger.info('Found {} changed records'.format(total))
+
+
+def _changed_records_query(start_date, end_date, staged=False):
     where = f"""m.change_date >= '{start_date.strftime('%Y-%m-%d')}' AND 
     m.change_date < '{end_date.strftime('%Y-%m-%d')}' AND
     m.added_date < '{start_date.strftime('%Y-%m-%d')}'"""
-    index_creation_query = INDEX_CREATION_QUERY.format(where=where)
-
     logger.info('Querying MAUDE db for records changed between {s} and {e}, and created prior to {s}'.format(
         s=start_date.strftime('%Y-%m-%d'),
         e=end_date.strftime('%Y-%m-%d')))
-    df = pd.read_sql(index_creation_query, conn)
+    return _records_query(staged).format(where=where)
 
-    logger.info('Found {} changed records'.format(len(df)))
 
-    if len(df) > 0:
-        logger.info('removing non-printing unicode characters')
-        df.replace({r'[^\x00-\x7F]+': ''}, regex=True, inplace=True)
-        df['split_by'] = df.added_date.map(lambda x: x.strftime('%Y-%m'))
-        df.drop(columns='added_date', inplace=True)
-        df.sort_values(by='split_by', axis=0, inplace=True)
-        df.set_index(keys='split_by', drop=False, inplace=True)
-        splits = df.split_by.unique().tolist()
-        logger.info(f'Indexes with changed records: {splits}')
-        return {s: df.loc[df.split_by == s] for s in splits}
+def _records_query(staged):
+    return STAGED_QUERY if staged else INDEX_CREATION_QUERY
+
+
+def refresh_staging_table(conn):
+    """Brings STAGING_TABLE up to date with the MAUDE tables, creating it on the first run; returns the rows upserted.
+
+    Only the master records added or changed since the newest added_date or change_date already staged go through the
+    INDEX_CREATION_QUERY join, so a refresh costs about as much as the rows that changed. The watermark day itself is
+    joined again, since more may have arrived later that day. Rows the join fans out to are collapsed to one per
+    index_id. Records deleted from MAUDE are not removed.
+    """
+    engine = create_engine(conn)
+    try:
+        with engine.begin() as connection:
+            _create_staging_table(connection)
+            watermark = connection.execute(text(
+                'SELECT GREATEST(MAX(added_date), MAX(change_date)) FROM {}'.format(STAGING_TABLE))).scalar()
+            if watermark is None:
+                logger.info('Filling {} from scratch'.format(STAGING_TABLE))
+                where = 'TRUE'
+            else:
+                logger.info('Refreshing {} with records added or changed since {}'.format(STAGING_TABLE, watermark))
+                day = watermark.strftime('%Y-%m-%d')
+                where = "m.added_date >= '{d}' OR m.change_date >= '{d}'".format(d=day)
+            result = connection.execute(text(_staging_upsert(where)))
+        logger.info('Upserted {} rows into {}'.format(result.rowcount, STAGING_TABLE))
+        return result.rowcount
+    finally:
+        engine.dispose()
+
+
+def _create_staging_table(connection):
+    # WITH NO DATA takes the column types from the query itself
+    connection.execute(text('CREATE TABLE IF NOT EXISTS {} AS {} WITH NO DATA'.format(
+        STAGING_TABLE, INDEX_CREATION_QUERY.format(where='FALSE'))))
+    # the unique index is also what ON CONFLICT (index_id) needs
+    for column, unique in (('index_id', True), ('added_date', False), ('change_date', False)):
+        connection.execute(text('CREATE {}INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})'.format(
+            'UNIQUE ' if unique else '', table=STAGING_TABLE, column=column)))
+
+
+def _staging_upsert(where):
+    columns = ', '.join(STAGING_COLUMNS)
+    updates = ', '.join('{c} = EXCLUDED.{c}'.format(c=c) for c in STAGING_COLUMNS if c != 'index_id')
+    # one row per index_id, a single INSERT may not hit the same conflicting row twice
+    return '''
+    INSERT INTO {table} ({columns})
+    SELECT DISTINCT ON (index_id) {columns} FROM ({query}) changed ORDER BY index_id
+    ON CONFLICT (index_id) DO UPDATE SET {updates}
+    '''.format(table=STAGING_TABLE, columns=columns, query=INDEX_CREATION_QUERY.format(where=where), updates=updates)
 
-    return None
+
+def _split_changed_records(df, workers=1):
+    logger.info('removing non-printing unicode characters')
+    clean_text(df, workers=workers)
+    # parsed, as drivers like sqlite's return dates as strings
+    df['split_by'] = pd.to_datetime(df.added_date).dt.strftime('%Y-%m')
+    df.drop(columns=['added_date', 'change_date'], inplace=True)
+    df.sort_values(by='split_by', axis=0, inplace=True)
+    df.set_index(keys='split_by', drop=False, inplace=True)
+    splits = df.split_by.unique().tolist()
+    logger.info(f'Indexes with changed records: {splits}')
+    return {s: df.loc[df.split_by == s] for s in splits}
+
+
+def _read_sql_chunks(query, conn, chunk_size):
+    # without stream_results psycopg2 pulls the whole result set into memory before pandas sees the first chunk
+    engine = create_engine(conn)
+    try:
+        with engine.connect().execution_options(stream_results=True) as connection:
+            for df in pd.read_sql(query, connection, chunksize=chunk_size):
+                if len(df) > 0:
+                    yield df
+    finally:
+        engine.dispose()
 
 
 def create_index(_es, _index_name, replace=False, elastic_version=6):
-    index_exists = _es.indices.exists(_index_name)
-    logger.info('Index: {} exists: {}'.format(_index_name, index_exists))
+    """Creates _index_name, deleting it first with replace, in a single request when it doesn't exist yet.
 
-    if not index_exists or replace:
-        if index_exists and replace:
-            logger.info('Deleting existing index: {}'.format(_index_name))
-            _es.indices.delete(_index_name)
+    An alias of that name counts as an existing index; with replace the indexes behind it are deleted instead.
 
-        schema_file = 'elastic_schema_6-x.json' if elastic_version < 7 else 'elastic_schema_7-x.json'
-        with open(pkg_resources.resource_filename('maude_etl', schema_file), 'r') as f:
-            schema = json.load(f)
-        logger.info('Creating index: {}'.format(_index_name))
-        logger.info(schema)
-        _es.indices.create(index=_index_name, body=schema, )
+    The settings and mappings come from the maude-text-* template, which is installed on the first call per client.
+    """
+    install_index_template(_es, elastic_version=elastic_version)
+    if replace:
+        # months rebuilt with alias_swap are aliases of maude-text-YYYY-MM-vN, which ES won't delete by name
+        indexes = sorted(_es.indices.get_alias(name=_index_name)) if _es.indices.exists_alias(name=_index_name) else []
+        logger.info('Deleting existing index: {}'.format(', '.join(indexes) or _index_name))
+        _es.indices.delete(index=','.join(indexes) or _index_name, ignore=404)
+    try:
+        _es.indices.create(index=_index_name)
+        logger.info('Created index: {}'.format(_index_name))
+    except RequestError as e:
+        if e.error not in ('resource_already_exists_exception', 'index_already_exists_exception'):
+            if not _is_alias_name(e):
+                raise
+        logger.info('Index: {} exists'.format(_index_name))
 
 
-def generate_data(_records, _index_name, elastic_version):
-    for r in _records:
-        _doc = {
-            "_index": _index_name,
-            "_id": r.get("index_id"),
-            "doc": r
-        }
-        if elastic_version < 7:
-            _doc['_type'] = "maude-text"
+def _is_alias_name(error):
+    # ES refuses to create an index named like an alias with an invalid_index_name_exception, "already exists as alias"
+    reason = error.info.get('error', {}).get('reason', '') if isinstance(error.info, dict) else ''
+    return error.error == 'invalid_index_name_exception' and 'alias' in str(reason)
 
-        print(_doc)
 
-        yield _doc
+def install_index_template(_es, elastic_version=6, force=False):
+    """Puts the schema as the template of every maude-text-* index, once per client unless forced."""
+    if _es in _templated_clients and not force:
+        return
+    body = dict(load_schema(elastic_version), index_patterns=[INDEX_PATTERN])
+    logger.info('Installing index template {} for {}'.format(INDEX_TEMPLATE, INDEX_PATTERN))
+    _es.indices.put_template(name=INDEX_TEMPLATE, body=body)
+    _templated_clients.add(_es)
 
 
-def create_documents(_es, _records, _index_name, elastic_version):
+@lru_cache()
+def load_schema(elastic_version=6):
+    """The parsed index schema for elastic_version, read once per process. Callers must not modify it."""
+    schema_file = 'elastic_schema_6-x.json' if elastic_version < 7 else 'elastic_schema_7-x.json'
+    return json.loads(resources.read_text(SCHEMA_PACKAGE, schema_file))
+
+
+@contextmanager
+def bulk_load_settings(_es, _index_name, force_merge_segments=None):
+    """Turns off refreshes and replicas on _index_name for the duration of a bulk load.
+
+    The index's own refresh_interval and number_of_replicas are put back afterwards, also when the load fails part
+    way through. After a successful load the index is refreshed and, with force_merge_segments, force merged down
+    to that many segments.
+    """
+    settings = _es.indices.get_settings(index=_index_name)[_index_name]['settings']['index']
+    # None resets a setting to the cluster default, for when the schema doesn't set it
+    original = {'refresh_interval': settings.get('refresh_interval'),
+                'number_of_replicas': settings.get('number_of_replicas')}
+    logger.info('Disabling refresh and replicas on {} for the bulk load, restoring {} afterwards'.format(
+        _index_name, original))
+    _es.indices.put_settings(index=_index_name, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+    try:
+        yield
+    finally:
+        logger.info('Restoring {} on {}'.format(original, _index_name))
+        _es.indices.put_settings(index=_index_name, body={'index': original})
+    logger.info('refreshing index: {}'.format(_index_name))
+    _es.indices.refresh(index=_index_name)
+    if force_merge_segments is not None:
+        logger.info('Force merging {} down to {} segments'.format(_index_name, force_merge_segments))
+        _es.indices.forcemerge(index=_index_name, max_num_segments=force_merge_segments, request_timeout=3600)
+
+
+def generate_data(_records, _index_name, elastic_version, op_type='index', dump_rate=None):
+    """Serializes the rows of the _records DataFrame into SerializedActions, without building a dict per document.
+
+    The sources are written column by column by DataFrame.to_json and wrapped in the "doc" field the documents are
+    indexed under. The header only differs by _id between documents, so the rest of it is encoded once. A dump_rate
+    fraction of the documents, DOCUMENT_DUMP_RATE by default, is logged.
+    """
+    metadata = {'_index': _index_name}
+    if elastic_version < 7:
+        metadata['_type'] = 'maude-text'
+    header = '{{"{}":{},"_id":'.format(op_type, json.dumps(metadata, separators=(',', ':'))[:-1])
+    if op_type == 'update':
+        # indexed documents keep their fields under "doc", so the partial update has to as well
+        prefix, suffix = '{"doc":{"doc":', '},"doc_as_upsert":true}'
+    else:
+        prefix, suffix = '{"doc":', '}'
+    # strings are escaped to ascii, so a newline only ever ends a record
+    sources = _records.to_json(orient='records', lines=True, date_format='iso').rstrip('\n').split('\n')
+    dump_rate = DOCUMENT_DUMP_RATE if dump_rate is None else dump_rate
+    for _id, source in zip(_records.index_id.astype(str), sources):
+        action = SerializedAction(_id, header + encode_basestring_ascii(_id) + '}}', prefix + source + suffix)
+        if dump_rate and random.random() < dump_rate:
+            logger.info('{}\n{}'.format(action.header, action.source))
+        yield action
+
+
+def create_documents(_es, _records, _index_name, elastic_version, bulk_options=None, op_type='index'):
+    """Bulk indexes the _records DataFrame, returns the documents that failed as {'_id', 'status', 'error'} dicts.
+
+    With bulk_options the documents go through parallel_bulk_index with those keyword arguments, otherwise they are
+    sent 200 at a time from a single thread without retries. With op_type 'update' the records are sent as partial
+    updates, creating the documents that don't exist yet.
+    """
     logger.info('Creating {} documents'.format(len(_records)))
+    start = time.perf_counter()
+    actions = list(generate_data(_records, _index_name=_index_name, elastic_version=elastic_version, op_type=op_type))
+    n_bytes = sum(map(_action_bytes, actions))
+    rates = _rates(len(actions), n_bytes, time.perf_counter() - start)
+    logger.info('serialized {} documents, {} bytes: {}'.format(len(actions), n_bytes, rates))
+    return _index_actions(_es, actions, n_bytes, bulk_options)
+
+
+def _index_actions(_es, actions, n_bytes, bulk_options):
+    start = time.perf_counter()
+    bulk_options = SINGLE_THREAD_BULK if bulk_options is None else bulk_options
+    indexed, errors = parallel_bulk_index(_es, actions, **bulk_options)
+    logger.info('{} documents inserted successfully: {}'.format(indexed,
+                                                               _rates(indexed, n_bytes, time.perf_counter() - start)))
+    if errors:
+        logger.error('{} documents failed, first error: {}'.format(len(errors), errors[0]))
+    return errors
+
+
+def _rates(documents, n_bytes, seconds):
+    seconds = max(seconds, 1e-9)
+    return '{:.2f}s, {:,.0f} documents/s, {:.2f} MB/s'.format(seconds, documents / seconds, n_bytes / seconds / 1e6)
+
+
+def parallel_bulk_index(_es,
+                        actions,
+                        thread_count=4,
+                        chunk_size=500,
+                        max_chunk_bytes=100 * 1024 * 1024,
+                        max_retries=5,
+                        initial_backoff=2,
+                        max_backoff=60,
+                        request_timeout=60):
+    """Indexes the SerializedActions from generate_data in _bulk requests sent over thread_count connections.
+
+    Requests hold at most chunk_size documents and max_chunk_bytes bytes. Documents the cluster rejects because it is
+    overloaded (429s and rejected executions) are sent again, waiting initial_backoff * 2 ** attempt seconds, capped
+    at max_backoff, before each of at most max_retries retries. Returns the number of indexed documents and the
+    documents that failed for good, as {'_id', 'status', 'error'} dicts.
+    """
+    indexed, errors = 0, []
+    pending = list(actions)
+    with ThreadPoolExecutor(thread_count) as pool:
+        for attempt in range(max_retries + 1):
+            retry = []
+            chunks = _chunk_actions(pending, chunk_size, max_chunk_bytes)
+            for chunk, items in zip(chunks, pool.map(lambda c: _send_chunk(_es, c, request_timeout), chunks)):
+                for action, item in zip(chunk, items):
+                    error = _bulk_error(item)
+                    if 200 <= error['status'] < 300:
+                        indexed += 1
+                    elif _is_rejection(error) and attempt < max_retries:
+                        retry.append(action)
+                    else:
+                        errors.append(error)
+            if not retry:
+                break
+            backoff = min(max_backoff, initial_backoff * 2 ** attempt)
+            logger.warning('{} documents rejected, retrying in {}s'.format(len(retry), backoff))
+            time.sleep(backoff)
+            pending = retry
+    return indexed, errors
+
+
+def _chunk_actions(actions, chunk_size, max_chunk_bytes):
+    chunks, chunk, size = [], [], 0
+    for action in actions:
+        action_bytes = _action_bytes(action)
+        if chunk and (len(chunk) == chunk_size or size + action_bytes > max_chunk_bytes):
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(action)
+        size += action_bytes
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _action_bytes(action):
+    # header and source are ascii, plus their two newlines
+    return len(action.header) + len(action.source) + 2
+
+
+def _send_chunk(_es, chunk, request_timeout):
+    body = ''.join('{}\n{}\n'.format(action.header, action.source) for action in chunk)
     try:
-        response = helpers.bulk(_es,
-                                generate_data(_records, _index_name=_index_name, elastic_version=elastic_version),
-                                chunk_size=200,
-                                request_timeout=60)
-        logger.info('{} documents inserted successfully'.format(response[0]))
-    except BulkIndexError as e:
-        logger.error(e)
+        return _es.bulk(body=body, request_timeout=request_timeout)['items']
+    except TransportError as e:
+        # the whole request failed, e.g. a 429 or a timeout, which fails every document in it
+        status = e.status_code if isinstance(e.status_code, int) else 0
+        return [{'index': {'_id': action.id, 'status': status, 'error': str(e)}} for action in chunk]
+
+
+def _bulk_error(item):
+    _, info = next(iter(item.items()))
+    return {'_id': info.get('_id'), 'status': info.get('status'), 'error': info.get('error')}
 
 
-def batch_document_updates(_es, _index_name, documents, batch_size=50000, elastic_version=6):
+def _is_rejection(error):
+    return error['status'] == 429 or 'es_rejected_execution_exception' in str(error['error'])
+
+
+def batch_document_updates(_es,
+                           _index_name,
+                           documents,
+                           batch_size=50000,
+                           elastic_version=6,
+                           refresh=True,
+                           bulk_options=None,
+                           op_type='index',
+                           batch_bytes=50 * 1024 * 1024,
+                           prefetch_batches=1):
+    """Indexes the documents DataFrame into _index_name batch by batch, returns the documents that failed.
+
+    Rows repeating an index_id are dropped up front, keeping the first. Batches hold at most batch_size documents and
+    batch_bytes bytes of NDJSON. They are serialized by a background thread while the previous batch is being sent,
+    staying at most prefetch_batches batches ahead, so only those few batches are ever held in serialized form.
+    """
+    errors = []
     if len(documents) > 0:
-        number_of_splits = ceil(len(documents) / batch_size)
-        logger.info('Splitting new documents into {} batches of {}'.format(
-            number_of_splits, batch_size))
-        doc_list = np.array_split(documents, number_of_splits)
-        for i, docs in enumerate(doc_list):
-            logger.info('inserting batch: {} of {}'.format(i, number_of_splits))
-            create_documents(_es,
-                             _records=docs.drop_duplicates(subset='index_id').to_dict(orient='records'),
-                             _index_name=_index_name,
-                             elastic_version=elastic_version)
-        logger.info('refreshing index: {}'.format(_index_name))
-        _es.indices.refresh(index=_index_name)
+        documents = _drop_duplicate_ids(documents)
+        logger.info('Indexing {} documents in batches of up to {} documents or {} bytes'.format(
+            len(documents), batch_size, batch_bytes))
+        start = time.perf_counter()
+        n_documents, n_bytes = 0, 0
+        batches = _serialized_batches(documents, _index_name, elastic_version, op_type, batch_size, batch_bytes)
+        for i, actions in enumerate(_prefetch(batches, prefetch_batches)):
+            size = sum(map(_action_bytes, actions))
+            logger.info('inserting batch: {} ({} documents, {} bytes)'.format(i, len(actions), size))
+            errors += _index_actions(_es, actions, size, bulk_options)
+            n_documents += len(actions)
+            n_bytes += size
+        logger.info('sent {} documents, {} bytes to {}: {}'.format(n_documents, n_bytes, _index_name,
+                                                                  _rates(n_documents, n_bytes,
+                                                                         time.perf_counter() - start)))
+        if refresh:
+            logger.info('refreshing index: {}'.format(_index_name))
+            _es.indices.refresh(index=_index_name)
+    return errors
+
+
+def _drop_duplicate_ids(documents):
+    return documents[~documents.index_id.duplicated()]
+
+
+def _serialized_batches(documents, _index_name, elastic_version, op_type, batch_size, batch_bytes):
+    # serialize batch_size rows at a time, so the NDJSON of the whole frame never exists at once
+    batch, size = [], 0
+    for start in range(0, len(documents), batch_size):
+        rows = documents.iloc[start:start + batch_size]
+        for action in generate_data(rows, _index_name=_index_name, elastic_version=elastic_version, op_type=op_type):
+            batch.append(action)
+            size += _action_bytes(action)
+            if len(batch) == batch_size or size >= batch_bytes:
+                yield batch
+                batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def _prefetch(items, max_ahead):
+    """Iterates items, producing the next up to max_ahead of them in a background thread meanwhile."""
+    buffer = queue.Queue(maxsize=max(1, max_ahead))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # the consumer may stop early, e.g. on a failed request, which must not leave the producer blocked
+        stop.set()
+        producer.join()
+
+
+def read_checkpoint(checkpoint_file):
+    """Returns the {'added_date', 'change_date'} watermark saved by write_checkpoint, or None before the first run."""
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, 'r') as f:
+        checkpoint = json.load(f)
+    return {k: date.fromisoformat(v) for k, v in checkpoint.items()}
+
+
+def write_checkpoint(checkpoint_file, checkpoint):
+    # write next to the old checkpoint and rename over it, so a crash never leaves a half written file behind
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({k: v.isoformat() for k, v in checkpoint.items()}, f)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def _setup_logging():
+    """Logs INFO and up to stderr, adding the handler once however many runs a process makes."""
+    global _log_handler
+    logger.setLevel(logging.INFO)
+    if _log_handler is None:
+        _log_handler = logging.StreamHandler()
+        _log_handler.setLevel(logging.INFO)
+        _log_handler.setFormatter(logging.Formatter('%(asctime)s|%(levelname)s|%(message)s'))
+        logger.addHandler(_log_handler)
+
+
+def incremental_elasticsearch_update(sql_conn,
+                                     es_conn,
+                                     checkpoint_file,
+                                     start_date=None,
+                                     elastic_version=6,
+                                     chunk_size=20000,
+                                     bulk_options=None,
+                                     staged=False):
+    """Sends only the records added or changed since the last run, as partial updates to their month's index.
+
+    The newest added_date and change_date seen are kept in checkpoint_file and the next run picks up from there.
+    Rows from the watermark day itself are read again, since more may have arrived later that day; the updates are
+    idempotent. The first run, without a checkpoint, starts from start_date. The checkpoint only moves forward when
+    every document was indexed, so failed documents are retried on the next run. With staged the records are read
+    from STAGING_TABLE, refreshed first, instead of joining the MAUDE tables.
+    """
+    _setup_logging()
+    sqlalchemy_conn = "postgresql://{user}:{password}@{host}:{port}/{dbname}".format(**sql_conn)
+    if staged:
+        refresh_staging_table(sqlalchemy_conn)
+    checkpoint = read_checkpoint(checkpoint_file)
+    if checkpoint is None:
+        if start_date is None:
+            raise ValueError('{} does not exist yet, pass start_date for the first run'.format(checkpoint_file))
+        # a datetime would neither compare with the dates read back nor round trip through read_checkpoint
+        start_date = pd.Timestamp(start_date).date()
+        checkpoint = {'added_date': start_date, 'change_date': start_date}
+    where = "m.added_date >= '{}' OR m.change_date >= '{}'".format(checkpoint['added_date'].strftime('%Y-%m-%d'),
+                                                                  checkpoint['change_date'].strftime('%Y-%m-%d'))
+    logger.info('Querying MAUDE db for records added or changed since {}'.format(checkpoint))
+
+    es = Elasticsearch(es_conn)
+    errors, touched_indexes = [], set()
+    new_checkpoint = dict(checkpoint)
+    for df in _read_sql_chunks(_records_query(staged).format(where=where), sqlalchemy_conn, chunk_size):
+        for column in ('added_date', 'change_date'):
+            newest = df[column].max()
+            if pd.notna(newest):
+                new_checkpoint[column] = max(new_checkpoint[column], pd.Timestamp(newest).date())
+        for month, records in _split_changed_records(df).items():
+            records = records.drop(columns='split_by')
+            index_name = f'maude-text-{month}'
+            if index_name not in touched_indexes:
+                create_index(es, index_name, elastic_version=elastic_version)
+                touched_indexes.add(index_name)
+            errors += batch_document_updates(es,
+                                             index_name,
+                                             records,
+                                             batch_size=chunk_size,
+                                             elastic_version=elastic_version,
+                                             refresh=False,
+                                             bulk_options=bulk_options,
+                                             op_type='update')
+    if touched_indexes:
+        logger.info('refreshing indexes: {}'.format(sorted(touched_indexes)))
+        es.indices.refresh(index=','.join(sorted(touched_indexes)))
+
+    if errors:
+        logger.error('{} documents failed, keeping checkpoint at {}'.format(len(errors), checkpoint))
+    else:
+        logger.info('Moving checkpoint to {}'.format(new_checkpoint))
+        write_checkpoint(checkpoint_file, new_checkpoint)
+    return errors
+
+
+def build_versioned_index(_es,
+                          alias,
+                          load,
+                          elastic_version=6,
+                          keep_versions=1,
+                          fast_load=False,
+                          force_merge_segments=None):
+    """Builds the next version of an index next to the one being served, then points alias at it.
+
+    load(index_name) bulk loads the new index, named like maude-text-2021-03-v7, and returns the number of documents
+    it should hold and the documents that failed. The alias is only swapped, in one atomic update, once the index
+    holds that many documents; otherwise the new index is deleted and readers keep the old one. Afterwards all but
+    the newest keep_versions versions are deleted. Versions are matched by maude-text-* too, so searches across
+    months should go through the month aliases rather than a wildcard when keeping more than one.
+    """
+    index_name = '{}-v{}'.format(alias, max(_index_versions(_es, alias), default=0) + 1)
+    create_index(_es, index_name, elastic_version=elastic_version)
+    try:
+        with _index_build(_es, index_name, fast_load, force_merge_segments):
+            expected, errors = load(index_name)
+        _es.indices.refresh(index=index_name)
+        count = _es.count(index=index_name)['count']
+        if count != expected:
+            raise RuntimeError('{} holds {} documents, expected {}'.format(index_name, count, expected))
+    except Exception:
+        logger.error('Building {} failed, deleting it and leaving {} as it is'.format(index_name, alias))
+        _es.indices.delete(index=index_name)
+        raise
+
+    actions = [{'add': {'index': index_name, 'alias': alias}}]
+    if _es.indices.exists_alias(name=alias):
+        actions = [{'remove': {'index': i, 'alias': alias}} for i in _es.indices.get_alias(name=alias)] + actions
+    elif _es.indices.exists(alias):
+        # months built before aliases were used are plain indexes, drop it in the same atomic update
+        actions = [{'remove_index': {'index': alias}}] + actions
+    logger.info('Pointing {} at {}'.format(alias, index_name))
+    _es.indices.update_aliases(body={'actions': actions})
+
+    versions = sorted(_index_versions(_es, alias).items(), reverse=True)
+    for _, old_index in versions[keep_versions:]:
+        logger.info('Deleting old version: {}'.format(old_index))
+        _es.indices.delete(index=old_index)
+    return errors
+
+
+def _index_versions(_es, alias):
+    versions = {}
+    for index_name in _es.indices.get(index='{}-v*'.format(alias)):
+        version = index_name[len(alias) + 2:]
+        if version.isdigit():
+            versions[int(version)] = index_name
+    return versions
 
 
 def update_elasticsearch_indexes(start_date,
                                  end_date,
                                  sql_conn,
                                  es_conn,
-                                 elastic_version=6):
-    logger.setLevel(logging.INFO)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s|%(levelname)s|%(message)s')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+                                 elastic_version=6,
+                                 chunk_size=None,
+                                 bulk_options=None,
+                                 fast_load=False,
+                                 force_merge_segments=None,
+                                 alias_swap=False,
+                                 month_concurrency=1,
+                                 staged=False):
+    """Rebuilds the start_date month's index and updates the documents changed between start_date and end_date.
 
+    With chunk_size the records are read from the database and indexed chunk_size rows at a time, so memory use
+    depends on chunk_size rather than on the number of records in the month. bulk_options are passed on to
+    parallel_bulk_index, e.g. {'thread_count': 8, 'chunk_size': 1000}; without them documents are indexed from a
+    single thread. With fast_load the rebuilt index has refreshes and replicas turned off while it loads, see
+    bulk_load_settings. With alias_swap the month is rebuilt into a new version behind an alias instead of being
+    deleted and recreated in place, see build_versioned_index. With month_concurrency the changed records of that many
+    months are updated at once, see update_changed_indexes. With staged the records are read from STAGING_TABLE,
+    refreshed first, instead of joining the MAUDE tables, see refresh_staging_table. Returns the documents that failed
+    to index.
+    """
+    _setup_logging()
     sqlalchemy_conn = "postgresql://{user}:{password}@{host}:{port}/{dbname}".format(**sql_conn)
+    index_name = 'maude-text-{}'.format(start_date.strftime('%Y-%m'))
+    if staged:
+        refresh_staging_table(sqlalchemy_conn)
+    es = Elasticsearch(es_conn, maxsize=connection_pool_size(bulk_options, month_concurrency))
+    return _update_elasticsearch_indexes(es, index_name, start_date, end_date, sqlalchemy_conn, elastic_version,
+                                         chunk_size, bulk_options, fast_load, force_merge_segments, alias_swap,
+                                         month_concurrency, staged)
+
+
+def _update_elasticsearch_indexes(es,
+                                  index_name,
+                                  start_date,
+                                  end_date,
+                                  sqlalchemy_conn,
+                                  elastic_version,
+                                  chunk_size,
+                                  bulk_options,
+                                  fast_load,
+                                  force_merge_segments,
+                                  alias_swap,
+                                  month_concurrency,
+                                  staged):
+    if chunk_size is not None:
+        return _stream_elasticsearch_updates(es, index_name, start_date, end_date, sqlalchemy_conn, elastic_version,
+                                             chunk_size, bulk_options, fast_load, force_merge_segments, alias_swap,
+                                             month_concurrency, staged)
+
     _records = get_new_records(start_date,
                                end_date,
-                               sqlalchemy_conn)
-    index_name = 'maude-text-{}'.format(start_date.strftime('%Y-%m'))
-    es = Elasticsearch(es_conn)
-    create_index(es, index_name, replace=True)
-    batch_document_updates(es,
-                           index_name,
-                           _records,
-                           batch_size=20000,
-                           elastic_version=elastic_version)
+                               sqlalchemy_conn,
+                               staged=staged)
+
+    def load(target_index):
+        if _records is None:
+            return 0, []
+        load_errors = batch_document_updates(es,
+                                             target_index,
+                                             _records,
+                                             batch_size=20000,
+                                             elastic_version=elastic_version,
+                                             refresh=False,
+                                             bulk_options=bulk_options)
+        return _expected_documents(set(_records.index_id), load_errors), load_errors
+
+    errors = _rebuild_index(es, index_name, load, elastic_version, fast_load, force_merge_segments, alias_swap)
 
     changed_records = get_changed_records(start_date=start_date,
                                           end_date=end_date,
-                                          conn=sqlalchemy_conn)
+                                          conn=sqlalchemy_conn,
+                                          staged=staged)
     if changed_records is not None:
-        for i, df in changed_records.items():
-            df.drop(columns='split_by', inplace=True)
-            logger.info(f'Updating changed documents. index: maude-text-{i}, # documents: {len(df)}')
-            batch_document_updates(es,
-                                   _index_name=f'maude-text-{i}',
-                                   documents=df,
-                                   batch_size=20000,
-                                   elastic_version=elastic_version)
+        errors += update_changed_indexes(es,
+                                         changed_records,
+                                         batch_size=20000,
+                                         elastic_version=elastic_version,
+                                         bulk_options=bulk_options,
+                                         concurrency=month_concurrency)
     else:
         logger.info('No newly changed records to update')
+    return errors
+
+
+def update_changed_indexes(_es,
+                           changed_records,
+                           batch_size=20000,
+                           elastic_version=6,
+                           refresh=True,
+                           bulk_options=None,
+                           concurrency=1):
+    """Sends the {month: DataFrame} changed_records to their maude-text-YYYY-MM indexes, concurrency months at a time.
+
+    The months share _es and so its connection pool, which should allow concurrency times the bulk thread_count
+    connections, see connection_pool_size. With refresh every touched index is refreshed once, in a single request,
+    after all of them are updated. Returns the documents that failed to index.
+    """
+    def update(month, df):
+        index_name = f'maude-text-{month}'
+        df = df.drop(columns='split_by')
+        logger.info(f'Updating changed documents. index: {index_name}, # documents: {len(df)}')
+        return batch_document_updates(_es,
+                                      _index_name=index_name,
+                                      documents=df,
+                                      batch_size=batch_size,
+                                      elastic_version=elastic_version,
+                                      refresh=False,
+                                      bulk_options=bulk_options)
+
+    with ThreadPoolExecutor(max(1, concurrency)) as pool:
+        results = list(pool.map(update, changed_records.keys(), changed_records.values()))
+    errors = [error for month_errors in results for error in month_errors]
+    if refresh and changed_records:
+        index_names = sorted(f'maude-text-{month}' for month in changed_records)
+        logger.info('refreshing indexes: {}'.format(index_names))
+        _es.indices.refresh(index=','.join(index_names))
+    return errors
+
+
+def connection_pool_size(bulk_options=None, month_concurrency=1):
+    """Connections per node needed for month_concurrency months each sending with bulk_options at once."""
+    thread_count = (bulk_options or SINGLE_THREAD_BULK).get('thread_count', 4)
+    # urllib3's default of 10 stays the floor
+    return max(10, month_concurrency * thread_count)
+
+
+def _stream_elasticsearch_updates(es,
+                                  index_name,
+                                  start_date,
+                                  end_date,
+                                  sqlalchemy_conn,
+                                  elastic_version,
+                                  chunk_size,
+                                  bulk_options,
+                                  fast_load,
+                                  force_merge_segments,
+                                  alias_swap,
+                                  month_concurrency,
+                                  staged):
+    def load(target_index):
+        load_errors, index_ids = [], set()
+        for df in stream_new_records(start_date, end_date, sqlalchemy_conn, chunk_size=chunk_size, staged=staged):
+            # batch_document_updates only dedupes within a chunk, the join's repeats can straddle two of them
+            df = df[~df.index_id.isin(index_ids)]
+            index_ids.update(df.index_id)
+            load_errors += batch_document_updates(es,
+                                                  target_index,
+                                                  df,
+                                                  batch_size=chunk_size,
+                                                  elastic_version=elastic_version,
+                                                  refresh=False,
+                                                  bulk_options=bulk_options)
+        return _expected_documents(index_ids, load_errors), load_errors
+
+    errors = _rebuild_index(es, index_name, load, elastic_version, fast_load, force_merge_segments, alias_swap)
+
+    changed_indexes, changed_ids = set(), set()
+    for changed_records in stream_changed_records(start_date, end_date, sqlalchemy_conn, chunk_size=chunk_size,
+                                                  staged=staged):
+        changed_records = {month: df[~df.index_id.isin(changed_ids)] for month, df in changed_records.items()}
+        changed_records = {month: df for month, df in changed_records.items() if len(df) > 0}
+        for df in changed_records.values():
+            changed_ids.update(df.index_id)
+        errors += update_changed_indexes(es,
+                                         changed_records,
+                                         batch_size=chunk_size,
+                                         elastic_version=elastic_version,
+                                         refresh=False,
+                                         bulk_options=bulk_options,
+                                         concurrency=month_concurrency)
+        changed_indexes.update(f'maude-text-{month}' for month in changed_records)
+    if changed_indexes:
+        logger.info('refreshing indexes: {}'.format(sorted(changed_indexes)))
+        es.indices.refresh(index=','.join(sorted(changed_indexes)))
+    else:
+        logger.info('No newly changed records to update')
+    return errors
+
+
+def _rebuild_index(es, index_name, load, elastic_version, fast_load, force_merge_segments, alias_swap):
+    if alias_swap:
+        return build_versioned_index(es,
+                                     index_name,
+                                     load,
+                                     elastic_version=elastic_version,
+                                     fast_load=fast_load,
+                                     force_merge_segments=force_merge_segments)
+    create_index(es, index_name, replace=True, elastic_version=elastic_version)
+    with _index_build(es, index_name, fast_load, force_merge_segments):
+        _, errors = load(index_name)
+    if not fast_load:
+        logger.info('refreshing index: {}'.format(index_name))
+        es.indices.refresh(index=index_name)
+    return errors
+
+
+def _expected_documents(index_ids, errors):
+    return len(index_ids - {e['_id'] for e in errors})
+
+
+@contextmanager
+def _index_build(es, index_name, fast_load, force_merge_segments):
+    if not fast_load:
+        yield
+        return
+    with bulk_load_settings(es, index_name, force_merge_segments=force_merge_segments):
+        yield